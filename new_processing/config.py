@@ -78,6 +78,11 @@ class Sql(object):
     CREATE_TABLE = 'CREATE TABLE {} ({})'
     COPY_IMPORT = "COPY {}({}) FROM '{}' WITH CSV HEADER"
     COPY_EXPORT = "COPY ({}) TO '{}dump.csv' CSV DELIMITER ','"
+    SELECT_OCDIDS = 'SELECT id, name, is_current, is_exception, ocdid FROM ocdid'
+    UPDATE_OCDID = 'UPDATE ocdid SET name = %s, is_current = %s, is_exception = %s, ocdid = %s WHERE id = %s'
+    DELETE_OCDIDS = 'DELETE FROM ocdid WHERE id = ANY(%s)'
+    # the bucket of an ocdid is its prefix and district type, up to the last ':'
+    CLEAR_DISTRICT_OCDIDS = "UPDATE electoral_district SET ocdid = NULL WHERE substring(ocdid from '^(.*):[^:]*$') = ANY(%s)"
 
 class District(object):
     LEVELS = {'country':'country',
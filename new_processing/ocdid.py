@@ -1,6 +1,9 @@
 #!/usr/bin/env python
+import cPickle
 import requests
+from functools import partial
 from fuzzywuzzy import fuzz,process
+from fuzzywuzzy.utils import full_process
 from operator import itemgetter
 from config import Ocdid,Match,District
 """
@@ -8,264 +11,395 @@ Module to parse official ocdid data accept district data, and attempt to
   match given data to official ocdids. Provides ratios data for inexact
   matches and a list of closest matches when searching
 
+Data is held by an OcdidIndex that loads on first use, the module level
+  functions wrap a default index over Ocdid.OCDID_DATA. Importing the module
+  is free, and the index can be rebuilt from the database cursor directly or
+  saved to a snapshot and read back from it without parsing.
+
 Requirements:
 Python2.7
 Requests
 fuzzywuzzy
 
 """
-                
-def is_ocdid(ocdid):
-    """Check whether given ocdid is contained in the official ocdid list
 
-    Keyword arguments:
-    ocdid -- ocdid value to check if exists in the official ocdid list
+# process.extractOne's default scorer, for already processed choices
+score = partial(fuzz.WRatio,full_process=False)
 
-    Returns:
-    True -- ocdid exists
-    False -- ocdid not found (could be candidate for new ocdid)
+class OcdidIndex(object):
+    """Official ocdid data and the matching functions that use it. Data is
+    read by the loader on first access, so creating an index is cheap
 
+    Attributes (loaded on first use):
+    ocdid_set -- set of all current, non-exception ocdids
+    exceptions -- dict of exception ocdids to their official ocdid
+    ocdids -- dict of ocdid_prefix -> district_type -> [names]
     """
-    if ocdid in ocdid_set:
-        return True
-    else:
-        return False
-
-def is_exception(ocdid):
-    """Check whether given ocdid is contained in the exception list
-
-    Keyword arguments:
-    ocdid -- ocdid value to check if exists in the exception list
 
-    Returns:
-    True -- ocdid exists
-    False -- ocdid not found (could be candidate for new ocdid)
+    def __init__(self,loader):
+        self._loader = loader
+        self._data = None
+        self._processed = {}
+
+    @classmethod
+    def from_file(cls,path):
+        """Index over an exported 'id,ocdid' file (see Ocdid.EXPORT_QUERY)"""
+        def loader():
+            with open(path,'r') as f:
+                return parse_lines(f.read().strip().split('\n'))
+        return cls(loader)
+
+    @classmethod
+    def from_url(cls,url):
+        """Index over an exported 'id,ocdid' file served at a url"""
+        return cls(lambda: parse_lines(requests.get(url).text.strip().split('\n')))
+
+    @classmethod
+    def from_cursor(cls,cursor,query=Ocdid.EXPORT_QUERY):
+        """Index straight from the ocdid table, skipping the file export"""
+        def loader():
+            cursor.execute(query)
+            return build_index_data((row[0],row[1] or '') for row in cursor.fetchall())
+        return cls(loader)
+
+    @classmethod
+    def from_snapshot(cls,path):
+        """Index over a snapshot file written by save_snapshot, as is"""
+        def loader():
+            try:
+                with open(path,'rb') as f:
+                    data = cPickle.load(f)
+            except (EOFError,ValueError,cPickle.UnpicklingError):
+                data = None
+            if not isinstance(data,tuple) or len(data) != 3:
+                raise IOError('Invalid ocdid snapshot: {}'.format(path))
+            return data
+        return cls(loader)
+
+    def save_snapshot(self,path):
+        """Writes the ocdid data to a snapshot file, see from_snapshot"""
+        with open(path,'wb') as f:
+            cPickle.dump(self.load(),f,cPickle.HIGHEST_PROTOCOL)
+
+    def load(self):
+        """Loads the ocdid data if it hasn't been loaded yet"""
+        if self._data is None:
+            self._data = self._loader()
+        return self._data
+
+    @property
+    def ocdid_set(self):
+        return self.load()[0]
+
+    @property
+    def exceptions(self):
+        return self.load()[1]
+
+    @property
+    def ocdids(self):
+        return self.load()[2]
+
+    def is_ocdid(self,ocdid):
+        """Check whether given ocdid is contained in the official ocdid list
+
+        Keyword arguments:
+        ocdid -- ocdid value to check if exists in the official ocdid list
+
+        Returns:
+        True -- ocdid exists
+        False -- ocdid not found (could be candidate for new ocdid)
+
+        """
+        if ocdid in self.ocdid_set:
+            return True
+        else:
+            return False
+
+    def is_exception(self,ocdid):
+        """Check whether given ocdid is contained in the exception list
+
+        Keyword arguments:
+        ocdid -- ocdid value to check if exists in the exception list
+
+        Returns:
+        True -- ocdid exists
+        False -- ocdid not found (could be candidate for new ocdid)
+
+        """
+        if ocdid in self.exceptions:
+            return True
+        else:
+            return False
+
+    def get_exception(self,ocdid):
+        """Returns official ocdid if ocdid value is in exceptions
+
+        Keyword arguments:
+        ocdid -- ocdid value to get official ocdid from exception list
+
+        Returns:
+        ocdid -- ocdid exception exists
+        None -- exception not found (could be candidate for new ocdid)
+
+        """
+        if ocdid in self.exceptions:
+            return self.exceptions[ocdid]
+        return None
 
-    """
-    if ocdid in exceptions:
-        return True
-    else:
-        return False
+    def match_name(self,ocdid_prefix,dist_type,dist_name):
+        """Given a district name, returns closest ocdid match in given district
+
+        Keyword arguments:
+        ocdid_prefix -- ocdid section up to type value, must exist in ocdids
+        dist_type -- district type value, must exist in ocdids[ocdid_prefix]
+        dist_name -- district name to attempt match
+
+        Returns:
+        ocdid,ratio -- if match found, returns valid ocdid and name match ratio
+        None,-1 -- if match not found, returns None for ocdid and -1 match ratio
+
+        """
+
+        return self.match_names(ocdid_prefix,dist_type,[dist_name])[0]
+
+    def match_names(self,ocdid_prefix,dist_type,dist_names):
+        """Given a group of district names of one prefix and type, returns the
+        closest ocdid match for each, scoring the whole group against the
+        district list in one pass
+
+        Keyword arguments:
+        ocdid_prefix -- ocdid section up to type value, must exist in ocdids
+        dist_type -- district type value, must exist in ocdids[ocdid_prefix]
+        dist_names -- list of district names to attempt match
+
+        Returns:
+        [(ocdid,ratio)] -- one match_name result per name, in the same order
+
+        """
+        try:
+            choices = self.ocdids[ocdid_prefix][dist_type]
+            matrix = self.score_matrix(ocdid_prefix,dist_type,dist_names)
+        except KeyError:
+          #  print 'Invalid ocdid_prefix or dist_type provided'
+          #  print 'Prefix: {} Dist_type: {}'.format(ocdid_prefix,dist_type)
+            # no scores, the dona_ana override still applies
+            matrix = [[]]*len(dist_names)
+
+        results = []
+        for dist_name,scores in zip(dist_names,matrix):
+            if dist_name == 'dona_ana':
+                results.append((u'ocd-division/country:us/state:nm/county:dona_ana'.encode('utf-8'),100))
+            elif not scores:
+                # if match fails, return empty values
+                results.append((None,-1))
+            else:
+                # first best scoring name wins ties, as in extractOne
+                best = max(range(len(scores)),key=scores.__getitem__)
+                results.append(self._resolve_match(ocdid_prefix,dist_type,choices[best],scores[best]))
+        return results
+
+    def score_matrix(self,ocdid_prefix,dist_type,dist_names):
+        """Scores each name against every district name of the prefix and
+        type (the scores process.extractOne would give), processing the
+        district names once per index and scoring repeated names once
+
+        Returns:
+        matrix -- matrix[i][j] is the score of dist_names[i] against
+                      ocdids[ocdid_prefix][dist_type][j]
+        """
+        key = (ocdid_prefix,dist_type)
+        if key not in self._processed:
+            self._processed[key] = [full_process(name,force_ascii=True) for name in self.ocdids[ocdid_prefix][dist_type]]
+        choices = self._processed[key]
+
+        rows = {}
+        matrix = []
+        for dist_name in dist_names:
+            query = full_process(dist_name,force_ascii=True)
+            if query not in rows:
+                rows[query] = [score(query,choice) for choice in choices]
+            matrix.append(rows[query])
+        return matrix
+
+    def _resolve_match(self,ocdid_prefix,dist_type,id_val,ratio):
+        # format ocdid, check that it exists, return id value and match ratio
+        ocdid = u'{}/{}:{}'.format(ocdid_prefix,dist_type,id_val)
+
+        if self.is_ocdid(ocdid):
+            return ocdid,ratio
+        elif self.is_exception(ocdid):
+            return self.get_exception(ocdid),ratio
+        else:
+            return None,-1
+
+    def match_type(self,ocdid_prefix,dist_type,dist_count):
+        """Given a district type and count, returns official ocdid district type
+
+        Keyword arguments:
+        ocdid_prefix -- ocdid section up to type value, must exist in ocdids
+        dist_type -- district type value, suggested types are: park, ward, school,
+                         education, commission, council, district (generic)
+        dist_count -- count of districts of given type in specific geography
+
+        Returns:
+        key -- if match found, returns valid ocdid and name match ratio
+        'No match' -- if not match found, returns None for ocdid and -1 match ratio
+
+        """
+        # default initial values for key, district length difference, and 
+        key = ''
+        diff_len = 1000
+        type_ratio = 0
+
+        if ocdid_prefix == 'ocd-division/country:us/state:nm/county:dona_ana':
+            ocdid_prefix = u'ocd-division/country:us/state:nm/county:do\xf1a_ana'.encode('utf-8')
+        if ocdid_prefix not in self.ocdids:
+            return None
+
+        for k,v in self.ocdids[ocdid_prefix].iteritems():
+      #      if ocdid_prefix.startswith('ocd-division/country:us/state:md'):
+      #          print k
+      #          print len(v)
+            #special case for school based districts, must be explicitly requested
+            if 'school' in k and dist_type != 'school':
+                continue
+            if 'precinct' in k and dist_type != 'precinct':
+                continue
+            # matches to district closest in count, using district type as a
+            # secondary matching trait, 'district' is the generic type
+            new_diff_len = abs(len(v)-dist_count)
+            new_type_ratio = fuzz.ratio(k,dist_type)
+            if new_diff_len < diff_len:
+                diff_len = new_diff_len
+                key = k
+                type_ratio = new_type_ratio
+            elif new_diff_len == diff_len and dist_type != 'district' and new_type_ratio > type_ratio:
+                key = k
+                type_ratio = new_type_ratio
+
+        # district length difference must be less than 5% for a valid match
+        if float(diff_len)/dist_count < .05:
+            return key
+        else:
+            return None
+
+    def name_search(self,name):
+        """Given a district name, searches for all matching ocdids
+
+        ***SLOW MATCHING*** 
+        searches everything, use a more limiting search for quicker results
+
+        Keyword arguments:
+        name -- district name to search for
+
+        Returns:
+        match_list[:MATCH_LIMIT] -- a list of the top 'MATCH_LIMIT' matches that
+                                        that at least meet 'MATCH_RATIO'
+
+        """
+        match_list = []
+
+        for prefix,district in self.ocdids.iteritems():
+            for dist_type,dist_names in district.iteritems():
+                # pull the closest match from each set of districts, adds to
+                # match_list if > MATCH_RATIO
+                match_vals = process.extractOne(name,dist_names)
+                if match_vals and match_vals[1] > Match.RATIO:
+                    match_list.append((match_vals[1],'{}/{}:{}'.format(prefix,dist_type,match_vals[0])))
 
-def get_exception(ocdid):
-    """Returns official ocdid if ocdid value is in exceptions
+        # sorts and returns top MATCH_LIMIT matches
+        match_list = sorted(match_list,key=itemgetter(0))
+        match_list.reverse()
+        return match_list[:Match.LIMIT]
+
+    def type_name_search(self,type_val,name):
+        """Given a district name and type, searches for all matching ocdids
+
+        Keyword arguments:
+        type_val -- district type to search for, valid types: anc, cd, county,
+                        council, village, borough, ward, township, city, court,
+                        parish, state, territory, sldu, commissioner, sldl,
+                        precinct, town, school, country, region, census_area
+        name -- district name to search for
+
+        Returns:
+        match_list[:MATCH_LIMIT] -- a list of the top 'MATCH_LIMIT' matches that
+                                        that at least meet 'MATCH_RATIO' 
+
+        """
+        match_list = []
+
+        # if type_val is standard, use the set of valid district type matches
+        # otherwise accept 'all' matches
+        if type_val in District.TYPE_CONVERSIONS:
+            valid_dists = District.TYPE_CONVERSIONS[type_val]
+        else:
+            valid_dists == 'all'
+
+        for prefix,district in self.ocdids.iteritems():
+            for dist_type,dist_names in district.iteritems():
+                # pull the closest match from matching sets of districts, adds to
+                # match_list if > MATCH_RATIO
+                if valid_dists == 'all' or dist_type in valid_dists:
+                    match_vals = process.extractOne(name,dist_names)
+                    if match_vals and match_vals[1] > Match.RATIO:
+                        match_list.append((match_vals[1],'{}/{}:{}'.format(prefix,dist_type,match_vals[0])))
+
+        # sorts and returns top MATCH_LIMIT matches
+        match_list = sorted(match_list,key=itemgetter(0))
+        match_list.reverse()
+        return match_list[:Match.LIMIT]
+
+
+    def print_subdistrict_data(self,ocdid_prefix):
+        """Given a district name, returns closest ocdid match in given district
+
+        Keyword arguments:
+        ocdid_prefix -- district name to attempt match
+
+        """
+        print ocdid_prefix
+        for k,v in self.ocdids[ocdid_prefix].iteritems():
+            print '  - {}:{}'.format(k,v)
 
-    Keyword arguments:
-    ocdid -- ocdid value to get official ocdid from exception list
+def is_ocdid(ocdid):
+    return index.is_ocdid(ocdid)
 
-    Returns:
-    ocdid -- ocdid exception exists
-    None -- exception not found (could be candidate for new ocdid)
+def is_exception(ocdid):
+    return index.is_exception(ocdid)
 
-    """
-    if ocdid in exceptions:
-        return exceptions[ocdid]
-    return None
+def get_exception(ocdid):
+    return index.get_exception(ocdid)
 
 def match_name(ocdid_prefix,dist_type,dist_name):
-    """Given a district name, returns closest ocdid match in given district
-
-    Keyword arguments:
-    ocdid_prefix -- ocdid section up to type value, must exist in ocdids
-    dist_type -- district type value, must exist in ocdids[ocdid_prefix]
-    dist_name -- district name to attempt match
+    return index.match_name(ocdid_prefix,dist_type,dist_name)
 
-    Returns:
-    ocdid,ratio -- if match found, returns valid ocdid and name match ratio
-    None,-1 -- if match not found, returns None for ocdid and -1 match ratio
-
-    """
-    
-    if dist_name == 'dona_ana':
-        return u'ocd-division/country:us/state:nm/county:dona_ana'.encode('utf-8'), 100
-
-    # from list of districts of a given type, find the closest match
-    try:
-        match = process.extractOne(dist_name,ocdids[ocdid_prefix][dist_type])
-    except KeyError:
-      #  print 'Invalid ocdid_prefix or dist_type provided'
-      #  print 'Prefix: {} Dist_type: {}'.format(ocdid_prefix,dist_type)
-        return None,-1
-
-    # if match fails, return empty values
-    if not match:
-        return None,-1
-    id_val,ratio = match
-    
-    #
-    #if ocdid_prefix.endswith(u'do\xf1a_ana'):
-    #    return u'ocd-division/country:us/state:nm/county:dona_ana',100
-
-    # format ocdid, check that it exists, return id value and match ratio
-    ocdid = u'{}/{}:{}'.format(ocdid_prefix,dist_type,id_val)
-  
-
-    if is_ocdid(ocdid):
-        return ocdid,ratio
-    elif is_exception(ocdid):
-        return get_exception(ocdid),ratio
-    else:
-        return None,-1
+def match_names(ocdid_prefix,dist_type,dist_names):
+    return index.match_names(ocdid_prefix,dist_type,dist_names)
 
 def match_type(ocdid_prefix,dist_type,dist_count):
-    """Given a district type and count, returns official ocdid district type
-
-    Keyword arguments:
-    ocdid_prefix -- ocdid section up to type value, must exist in ocdids
-    dist_type -- district type value, suggested types are: park, ward, school,
-                     education, commission, council, district (generic)
-    dist_count -- count of districts of given type in specific geography
-
-    Returns:
-    key -- if match found, returns valid ocdid and name match ratio
-    'No match' -- if not match found, returns None for ocdid and -1 match ratio
-
-    """
-    # default initial values for key, district length difference, and 
-    key = ''
-    diff_len = 1000
-    type_ratio = 0
-
-    if ocdid_prefix == 'ocd-division/country:us/state:nm/county:dona_ana':
-        ocdid_prefix = u'ocd-division/country:us/state:nm/county:do\xf1a_ana'.encode('utf-8')
-    if ocdid_prefix not in ocdids:
-        return None
-
-    for k,v in ocdids[ocdid_prefix].iteritems():
-  #      if ocdid_prefix.startswith('ocd-division/country:us/state:md'):
-  #          print k
-  #          print len(v)
-        #special case for school based districts, must be explicitly requested
-        if 'school' in k and dist_type != 'school':
-            continue
-        if 'precinct' in k and dist_type != 'precinct':
-            continue
-        # matches to district closest in count, using district type as a
-        # secondary matching trait, 'district' is the generic type
-        new_diff_len = abs(len(v)-dist_count)
-        new_type_ratio = fuzz.ratio(k,dist_type)
-        if new_diff_len < diff_len:
-            diff_len = new_diff_len
-            key = k
-            type_ratio = new_type_ratio
-        elif new_diff_len == diff_len and dist_type != 'district' and new_type_ratio > type_ratio:
-            key = k
-            type_ratio = new_type_ratio
-
-    # district length difference must be less than 5% for a valid match
-    if float(diff_len)/dist_count < .05:
-        return key
-    else:
-        return None
+    return index.match_type(ocdid_prefix,dist_type,dist_count)
 
 def name_search(name):
-    """Given a district name, searches for all matching ocdids
-        
-    ***SLOW MATCHING*** 
-    searches everything, use a more limiting search for quicker results
-
-    Keyword arguments:
-    name -- district name to search for
-
-    Returns:
-    match_list[:MATCH_LIMIT] -- a list of the top 'MATCH_LIMIT' matches that
-                                    that at least meet 'MATCH_RATIO'
-
-    """
-    match_list = []
-    
-    for prefix,district in ocdids.iteritems():
-        for dist_type,dist_names in district.iteritems():
-            # pull the closest match from each set of districts, adds to
-            # match_list if > MATCH_RATIO
-            match_vals = process.extractOne(name,dist_names)
-            if match_vals and match_vals[1] > Match.RATIO:
-                match_list.append((match_vals[1],'{}/{}:{}'.format(prefix,dist_type,match_vals[0])))
-    
-    # sorts and returns top MATCH_LIMIT matches
-    match_list = sorted(match_list,key=itemgetter(0))
-    match_list.reverse()
-    return match_list[:Match.LIMIT]
+    return index.name_search(name)
 
 def type_name_search(type_val,name):
-    """Given a district name and type, searches for all matching ocdids
-
-    Keyword arguments:
-    type_val -- district type to search for, valid types: anc, cd, county,
-                    council, village, borough, ward, township, city, court,
-                    parish, state, territory, sldu, commissioner, sldl,
-                    precinct, town, school, country, region, census_area
-    name -- district name to search for
-
-    Returns:
-    match_list[:MATCH_LIMIT] -- a list of the top 'MATCH_LIMIT' matches that
-                                    that at least meet 'MATCH_RATIO' 
-
-    """
-    match_list = []
-
-    # if type_val is standard, use the set of valid district type matches
-    # otherwise accept 'all' matches
-    if type_val in District.TYPE_CONVERSIONS:
-        valid_dists = District.TYPE_CONVERSIONS[type_val]
-    else:
-        valid_dists == 'all'
-
-    for prefix,district in ocdids.iteritems():
-        for dist_type,dist_names in district.iteritems():
-            # pull the closest match from matching sets of districts, adds to
-            # match_list if > MATCH_RATIO
-            if valid_dists == 'all' or dist_type in valid_dists:
-                match_vals = process.extractOne(name,dist_names)
-                if match_vals and match_vals[1] > Match.RATIO:
-                    match_list.append((match_vals[1],'{}/{}:{}'.format(prefix,dist_type,match_vals[0])))
-
-    # sorts and returns top MATCH_LIMIT matches
-    match_list = sorted(match_list,key=itemgetter(0))
-    match_list.reverse()
-    return match_list[:Match.LIMIT]
-
+    return index.type_name_search(type_val,name)
 
 def print_subdistrict_data(ocdid_prefix):
-    """Given a district name, returns closest ocdid match in given district
-
-    Keyword arguments:
-    ocdid_prefix -- district name to attempt match
-
-    """
-    print ocdid_prefix
-    for k,v in ocdids[ocdid_prefix].iteritems():
-        print '  - {}:{}'.format(k,v)
-
-""" If a url is provided, use 'requests' to obtain ocdid data
-        otherwise, read from file system """
-f = open(Ocdid.OCDID_DATA,'r')
-r = f.read()
-
-""" Generate a set of only ocdid data with empty values removed """
-ocdid_set = set()
-exceptions = {}
-ocdids = {}
-
-for line in r.strip().split('\n'):
-    line = line.split(',')
-    ocdid = line[0]
-    if line[1]:
-        exceptions[ocdid] = line[1]
-    else:
-        ocdid_set.add(ocdid)
-
-    prefix_div = ocdid.rfind('/')
-    ocdid_prefix = ocdid[:prefix_div]
-    type_val,name = ocdid[prefix_div+1:].split(':')
-    if ocdid_prefix not in ocdids:
-        ocdids[ocdid_prefix] = {}
-    if type_val not in ocdids[ocdid_prefix]:
-        ocdids[ocdid_prefix][type_val] = []
-    ocdids[ocdid_prefix][type_val].append(name)
-
-
-""" Create a dictionary of ocdid data in the format:
+    index.print_subdistrict_data(ocdid_prefix)
+
+def parse_lines(lines):
+    """Splits exported 'id,ocdid' lines into (id,ocdid) pairs"""
+    rows = []
+    for line in lines:
+        line = line.split(',')
+        rows.append((line[0],line[1]))
+    return build_index_data(rows)
+
+def build_index_data(rows):
+    """ Generate a set of only ocdid data with empty values removed, and a
+    dictionary of ocdid data in the format:
         {
             ocdid_prefix:
             {
@@ -273,4 +407,25 @@ for line in r.strip().split('\n'):
                     [name_1,name_2,etc.]
             }
         } 
-"""
+    """
+    ocdid_set = set()
+    exceptions = {}
+    ocdids = {}
+
+    for ocdid,official in rows:
+        if official:
+            exceptions[ocdid] = official
+        else:
+            ocdid_set.add(ocdid)
+
+        prefix_div = ocdid.rfind('/')
+        ocdid_prefix = ocdid[:prefix_div]
+        type_val,name = ocdid[prefix_div+1:].split(':')
+        if ocdid_prefix not in ocdids:
+            ocdids[ocdid_prefix] = {}
+        if type_val not in ocdids[ocdid_prefix]:
+            ocdids[ocdid_prefix][type_val] = []
+        ocdids[ocdid_prefix][type_val].append(name)
+    return ocdid_set,exceptions,ocdids
+
+index = OcdidIndex.from_file(Ocdid.OCDID_DATA)
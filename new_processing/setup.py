@@ -9,7 +9,9 @@ import re
 from datetime import datetime
 from csv import DictReader,DictWriter
 from argparse import ArgumentParser
+from multiprocessing import Pool
 from config import Conn,Database,Sql,District,Output,Ocdid,OfficeHolder,Match
+import ocdid
 
 date_val = str(datetime.now())
 date_val = date_val[:date_val.find('.')]
@@ -106,6 +108,37 @@ def get_ocdids():
                     data[id_val]['is_current'] = 1
     return data
 
+def ocdid_values(row):
+    return (row['name'] or '',int(row['is_current']),int(row['is_exception']),row.get('ocdid') or '')
+
+def update_ocdids():
+    # applies the ocdid files to the ocdid table in place, only touching the
+    # ids added, removed or changed since the table was loaded. Added ids go
+    # in first so changed sameAs values can reference them
+    data = get_ocdids()
+    cur.execute(Sql.SELECT_OCDIDS)
+    loaded = {}
+    for id_val,name,is_current,is_exception,same_as in cur.fetchall():
+        loaded[id_val] = ocdid_values({'name':name,'is_current':is_current,
+                                        'is_exception':is_exception,'ocdid':same_as})
+
+    added = dict((k,v) for k,v in data.iteritems() if k not in loaded)
+    removed = [k for k in loaded if k not in data]
+    changed = [v for k,v in data.iteritems() if k in loaded and ocdid_values(v) != loaded[k]]
+
+    if added:
+        load_data(Ocdid.OCDID_FILES,{'ocdid':added})
+    cur.executemany(Sql.UPDATE_OCDID,[(v['name'],bool(v['is_current']),bool(v['is_exception']),
+                                        v.get('ocdid') or None,v['id']) for v in changed])
+    # districts assigned to any ocdid of a prefix and type that gained, lost
+    # or changed an id are left for the next match, their best match may
+    # differ now
+    buckets = set(k[:k.rfind(':')] for k in added.keys()+removed+[v['id'] for v in changed])
+    cur.execute(Sql.CLEAR_DISTRICT_OCDIDS,(list(buckets),))
+    cur.execute(Sql.DELETE_OCDIDS,(removed,))
+    conn.commit()
+    print 'Ocdids: {} added, {} removed, {} changed'.format(len(added),len(removed),len(changed))
+
 def clear_dir():
     if not path.exists(Output.DIR):
         makedirs(Output.DIR)
@@ -169,104 +202,166 @@ def get_full_prefix(prefix_list):
                 return id_val,ratio
     return None,-1
 
-def is_sub_district(e_district,prefix_list):
-    if 'precinct ' in e_district or 'district ' in e_district:
-        return True
-    elif ' ward ' in e_district or (e_district.startswith('ward ') and len(e_district) < 9):
-        return True
-    else:
-        return False
-
-def get_sub_district(e_district,prefix_list):
-    for t in District.TYPES:
-        if t in e_district:
-            if t == 'house' or t == 'assembly':
-                dist_type = 'sldl'
-            elif t == 'senate':
-                dist_type = 'sldu'
-            else:
-                dist_type = t
-            break
-    for s in District.SPLIT_TYPES:
-        if s in e_district:
-            return dist_type,e_district.split(s)[-1].strip().replace(' ','_')
-
-def assign_ocdids():
+# 'ward' logic here to avoid capturing stuff like 'Ward County'
+SUB_DISTRICT = re.compile(r'precinct |district | ward |^ward .{0,3}$',re.DOTALL)
+# every occurrence of every district and split type, overlapping or not
+DISTRICT_WORDS = re.compile('(?=({}))'.format(
+    '|'.join(re.escape(word) for word in District.TYPES + District.SPLIT_TYPES)))
+LEGISLATIVE_TYPES = {'house':'sldl','assembly':'sldl','senate':'sldu'}
+sub_districts = {}
+
+def parse_sub_district(e_district):
+    # returns (dist_type,value) for names of districts below the 'Body
+    # Represents' level (council district 3 -> council,3), None otherwise.
+    # The type is the first of District.TYPES in the name, the value what
+    # follows the last occurrence of the first of District.SPLIT_TYPES.
+    # Names repeat heavily, so each one is parsed once
+    if e_district in sub_districts:
+        return sub_districts[e_district]
+    sub_district = None
+    if SUB_DISTRICT.search(e_district):
+        ends = {}
+        for match in DISTRICT_WORDS.finditer(e_district):
+            ends[match.group(1)] = match.end(1)
+        dist_type = next((t for t in District.TYPES if t in ends),None)
+        split = next((s for s in District.SPLIT_TYPES if s in ends),None)
+        if dist_type and split:
+            sub_district = (LEGISLATIVE_TYPES.get(dist_type,dist_type),
+                            e_district[ends[split]:].strip().replace(' ','_'))
+    sub_districts[e_district] = sub_district
+    return sub_district
+
+def scan_file(f):
+    # reads the office holders of one OfficeHolder.DIR file, returning each
+    # row with the prefix tuple and sub-district it is matched on
+    scanned = []
+    with open(OfficeHolder.DIR + f,'rU') as r:
+        reader = DictReader(r)
+
+        for row in reader:
+            state = row['Body Represents - State'].lower().replace(' ','_')
+            county = row['Body Represents - County'].lower().replace(' ','_')
+            muni = row['Body Represents - Muni'].lower().replace(' ','_')
+            ed = row['Electoral District'].lower()
+
+            prefix_list = []
+            if state: 
+                prefix_list.append('state:{}'.format(state))
+            if county:
+                if state in District.ALT_COUNTIES:
+                    prefix_list.append('{}:{}'.format(District.ALT_COUNTIES[state],county))
+                else:
+                    if state == 'nh' and county.startswith('co'):
+                        county = 'coos'
+                    prefix_list.append('county:{}'.format(county))
+            if muni:
+                if muni == 'dc':
+                    prefix_list.append('district:{}'.format(muni))
+                else:
+                    prefix_list.append('place:{}'.format(muni))
+
+            scanned.append((row,tuple(prefix_list),parse_sub_district(ed)))
+    return scanned
+
+def group_file(scanned,prefixes):
+    # sets the match of one file's rows that are matched on their prefix, and
+    # groups its sub-districts by matched prefix and type as matching the file
+    # on its own did. Returns the matched rows and the groups
     oh_data = []
+    unmatched = {}
+    for row,ocdid_key,sub_district in scanned:
+        full_prefix,ratio = prefixes[ocdid_key]
+        if sub_district:
+            d_type,d_name = sub_district
+            unmatched_key = u'{}:{}'.format(full_prefix,d_type)
+            if unmatched_key not in unmatched:
+                unmatched[unmatched_key] = {'prefix':full_prefix,'districts':{},'dist_type':d_type}
+            if d_name not in unmatched[unmatched_key]['districts']:
+                unmatched[unmatched_key]['districts'][d_name] = []
+            unmatched[unmatched_key]['districts'][d_name].append(row)
+        else:
+            if full_prefix == None:
+                full_prefix = ''
+            row['match_ratio'] = ratio
+            row['ocdid'] = full_prefix
+            oh_data.append(row)
+    return oh_data,unmatched.values()
+
+def resolve_prefix(ocdid_key):
+    # get_full_prefix modifies its list, the key is kept as is
+    return get_full_prefix(list(ocdid_key))
+
+def resolve_names(bucket):
+    full_prefix,type_val,d_names = bucket
+    return ocdid.match_names(full_prefix,type_val,d_names)
+
+def resolve(func,values,pool):
+    if pool:
+        return pool.map(func,values)
+    return map(func,values)
+
+def assign_ocdids(jobs=1):
+    # matches every file in two phases. All files are scanned first, then
+    # each distinct prefix, sub-district group size and district name is
+    # matched once for all of them, and the matches are joined back onto the
+    # rows. Sub-districts are still grouped file by file, so the rows and
+    # their order are those of matching each file on its own. With more than
+    # one job, prefixes and names are matched by a pool of processes forked
+    # once the ocdid data is loaded, which share it rather than loading or
+    # receiving their own copy
+    scans = []
     for f in listdir(OfficeHolder.DIR):
         print f
-        with open(OfficeHolder.DIR + f,'rU') as r:
-            reader = DictReader(r)
+        scans.append(scan_file(f))
+
+    pool = None
+    if jobs > 1:
+        ocdid.index.load()
+        pool = Pool(jobs)
+    try:
+        ocdid_keys = list(set(ocdid_key for scanned in scans for row,ocdid_key,sub_district in scanned))
+        prefixes = dict(zip(ocdid_keys,resolve(resolve_prefix,ocdid_keys,pool)))
+        files = [group_file(scanned,prefixes) for scanned in scans]
+
+        # match_type only depends on the group's prefix, type and size
+        type_vals = {}
+        names = {}
+        for oh_data,groups in files:
+            for v in groups:
+                type_key = (v['prefix'],v['dist_type'],len(v['districts']))
+                if type_key not in type_vals:
+                    type_vals[type_key] = ocdid.match_type(*type_key)
+                type_val = type_vals[type_key]
+                if type_val:
+                    names.setdefault((v['prefix'],type_val),set()).update(v['districts'])
+        buckets = [(full_prefix,type_val,list(d_names)) for (full_prefix,type_val),d_names in names.iteritems()]
+        name_matches = {}
+        for (full_prefix,type_val,d_names),matches in zip(buckets,resolve(resolve_names,buckets,pool)):
+            for d_name,match in zip(d_names,matches):
+                name_matches[(full_prefix,type_val,d_name)] = match
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
-            ocdid_vals = {}
-            unmatched = {}
-
-            for row in reader:
-                state = row['Body Represents - State'].lower().replace(' ','_')
-                county = row['Body Represents - County'].lower().replace(' ','_')
-                muni = row['Body Represents - Muni'].lower().replace(' ','_')
-                ed = row['Electoral District'].lower()
-
-                prefix_list = []
-                if state: 
-                    prefix_list.append('state:{}'.format(state))
-                if county:
-                    if state in District.ALT_COUNTIES:
-                        prefix_list.append('{}:{}'.format(District.ALT_COUNTIES[state],county))
-                    else:
-                        if state == 'nh' and county.startswith('co'):
-                            county = 'coos'
-                        prefix_list.append('county:{}'.format(county))
-                if muni:
-                    if muni == 'dc':
-                        prefix_list.append('district:{}'.format(muni))
-                    else:
-                        prefix_list.append('place:{}'.format(muni))
-
-                ocdid_key = tuple(prefix_list)
-                if ocdid_key in ocdid_vals:
-                    full_prefix,ratio = ocdid_vals[ocdid_key]['ocdid'],ocdid_vals[ocdid_key]['ratio']
-                else:
-    #                print prefix_list
-                    full_prefix,ratio = get_full_prefix(prefix_list)
-                    ocdid_vals[ocdid_key] = {'ocdid':full_prefix,'ratio':ratio}
-
-                if is_sub_district(ed,prefix_list):
-                    d_type,d_name = get_sub_district(ed,prefix_list)
-                    unmatched_key = u'{}:{}'.format(full_prefix,d_type)
-                    if unmatched_key not in unmatched:
-                        unmatched[unmatched_key] = {'prefix':full_prefix,'districts':{},'dist_type':d_type}
-                    if d_name not in unmatched[unmatched_key]['districts']:
-                        unmatched[unmatched_key]['districts'][d_name] = []
-                    unmatched[unmatched_key]['districts'][d_name].append(row)
+    oh_data = []
+    for file_data,groups in files:
+        oh_data.extend(file_data)
+        for v in groups:
+            full_prefix = v['prefix']
+            districts = v['districts']
+            type_val = type_vals[(full_prefix,v['dist_type'],len(districts))]
+            for d_name,rows in districts.iteritems():
+                if type_val:
+                    id_val,ratio = name_matches[(full_prefix,type_val,d_name)]
                 else:
-                    if full_prefix == None:
-                        full_prefix = ''
+                    id_val,ratio = None,-1
+                if id_val == None:
+                    id_val = ''
+                for row in rows:
                     row['match_ratio'] = ratio
-                    row['ocdid'] = full_prefix
+                    row['ocdid'] = id_val
                     oh_data.append(row)
-
-            for k,v in unmatched.iteritems():
-                full_prefix = v['prefix']
-                d_type = v['dist_type']
-                districts = v['districts']
-
-                type_val = ocdid.match_type(full_prefix,d_type,len(districts))
-                if not type_val:
-                    for d_name,rows in districts.iteritems():
-                        for row in rows:
-                            row['match_ratio'] = -1
-                            row['ocdid'] = ''
-                            oh_data.append(row)
-                else:
-                    for d_name,rows in districts.iteritems():
-                        id_val,ratio = ocdid.match_name(full_prefix,type_val,d_name) #If ratio fails here :(
-                        if id_val == None:
-                            id_val = ''
-                        for row in rows:
-                            row['match_ratio'] = ratio
-                            row['ocdid'] = id_val
-                            oh_data.append(row)
     return oh_data
 
 def split_data(oh_data):
@@ -343,10 +438,14 @@ def main():
     parser.add_argument('--all', action='store_true')
     parser.add_argument('--db', action='store_true')
     parser.add_argument('--ocdid', action='store_true')
+    parser.add_argument('--ocdid-delta', action='store_true',
+                        help='apply ocdid file changes to the loaded ocdid table')
     parser.add_argument('--office', action='store_true')
+    parser.add_argument('--jobs', action='store', type=int, default=1,
+                        help='number of office holder files to match at once')
 
     args = parser.parse_args()
-    if not (args.all or args.db or args.ocdid or args.office):
+    if not (args.all or args.db or args.ocdid or args.ocdid_delta or args.office):
         args.all = True
 
     if args.all or args.db:
@@ -355,12 +454,13 @@ def main():
         clear_dir()
         ocdid_data = {'ocdid':get_ocdids()}
         load_data(Ocdid.OCDID_FILES,ocdid_data)
+    if args.ocdid_delta:
+        clear_dir()
+        update_ocdids()
     if args.all or args.office:
         clear_dir()
         export_data(Ocdid.EXPORT_QUERY)
-        global ocdid
-        import ocdid
-        oh_data = assign_ocdids()
+        oh_data = assign_ocdids(args.jobs)
         office_holder_data = split_data(oh_data)
         load_data(OfficeHolder.OFFICE_HOLDER_FILES,office_holder_data)
     
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+import hashlib
+import json
+import os
+import sys
+
+"""
+Manifest of the staging files assign_ocdids has written, kept as a JSON
+  file between runs. Each staging file is recorded with what it was
+  assigned from: the checksum of its collection file, of the ocdid dataset
+  and of the assignment code and config. A collection file whose inputs all
+  match its record, and whose staging file is still the one written, doesn't
+  need to be assigned again.
+
+Requirements:
+Python3
+"""
+
+CHUNK_SIZE = 1 << 16
+
+# modules whose code or config the assigned ocdids depend on
+CODE_MODULES = ['ocdid', 'ocdid_store', 'ocdid_config', 'bktree',
+                'match_cache', 'external_sort', 'process_config']
+
+
+def file_hash(path):
+    """Returns the sha1 checksum of a file's contents, None if missing"""
+    checksum = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                checksum.update(chunk)
+    except FileNotFoundError:
+        return None
+    return checksum.hexdigest()
+
+
+def code_version(paths):
+    """Returns a checksum of the assignment code and config
+
+    Keyword arguments:
+    paths -- further files the output depends on (the script itself, an
+                 alias table), missing ones are skipped
+
+    Returns:
+    checksum -- sha1 of the files of CODE_MODULES and paths
+
+    """
+    checksum = hashlib.sha1()
+    modules = [sys.modules[name] for name in CODE_MODULES
+               if name in sys.modules]
+    for path in [module.__file__ for module in modules] + list(paths):
+        checksum.update('{}:{}\n'.format(os.path.basename(path),
+                                         file_hash(path)).encode('utf-8'))
+    return checksum.hexdigest()
+
+
+class AssignManifest(object):
+    """Record of the staging files written for one ocdid dataset and code
+    version
+
+    Attributes:
+    entries -- dict of file name -> dict of the 'input', 'dataset', 'code'
+                   and 'output' checksums it was assigned with
+    """
+
+    def __init__(self, path, dataset, code):
+        """Keyword arguments:
+        path -- JSON file to keep the manifest in, created if missing
+        dataset -- checksum of the ocdid dataset matches are made against,
+                       None when rows aren't matched
+        code -- checksum of the assignment code, see code_version
+        """
+        self.path = path
+        self.dataset = dataset
+        self.code = code
+        self._inputs = {}
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def is_current(self, filename, input_path, output_path):
+        """Checks whether a file's staging output is the one its current
+        inputs would give
+
+        Keyword arguments:
+        filename -- name of the collection file
+        input_path -- the collection file
+        output_path -- its staging file
+
+        Returns:
+        True -- the staging file can be kept
+        False -- the file has to be assigned
+
+        """
+        entry = self.entries.get(filename)
+        if entry is None:
+            return False
+        if entry['dataset'] != self.dataset or entry['code'] != self.code:
+            return False
+        if entry['input'] != self._input_hash(filename, input_path):
+            return False
+        return entry['output'] == file_hash(output_path)
+
+    def record(self, filename, input_path, output_path):
+        """Records the staging file just written for a collection file"""
+        self.entries[filename] = {
+            'input': self._input_hash(filename, input_path),
+            'dataset': self.dataset,
+            'code': self.code,
+            'output': file_hash(output_path)}
+
+    def _input_hash(self, filename, input_path):
+        """Checksum of a collection file, read once per run"""
+        if filename not in self._inputs:
+            self._inputs[filename] = file_hash(input_path)
+        return self._inputs[filename]
+
+    def drop_missing(self, filenames):
+        """Drops the entries of collection files no longer present
+
+        Keyword arguments:
+        filenames -- current collection file names
+
+        Returns:
+        dropped -- sorted names of the entries dropped
+
+        """
+        dropped = sorted(set(self.entries) - set(filenames))
+        for filename in dropped:
+            del self.entries[filename]
+        return dropped
+
+    def close(self):
+        """Writes the manifest to disk, replacing the previous one whole"""
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -8,10 +8,18 @@ from os import listdir
 import ocdid as ocdidlib
 import os.path
 from argparse import ArgumentParser
+from assign_manifest import AssignManifest, code_version
+from contextlib import redirect_stdout
+from external_sort import sorted_stream
+from functools import lru_cache
+from match_cache import MatchCache
+from operator import itemgetter
+from ocdid_config import Ocdid
 from process_config import Dirs, Assign
 from pprint import pprint
 import importlib
 import io
+import multiprocessing
 import psycopg2
 import psycopg2.extras
 import re
@@ -37,15 +45,40 @@ Assign ocdids by grouping data from each state and matching them to official
   and then matched based on district count and name similarity
 
 Requirements:
-    Python2.7
+    Python3
     ocdid module (+ module requirements)
 
+Rows arrive with their OCDID assigned, those without one are reported. With
+  --match, rows that arrive without an OCDID are matched from their 'Body
+  Represents' and 'Electoral District' values instead, with the match and
+  the closest other candidates written to the OCDID, ocdid_report and
+  ocdid_candidates fields. Match results are kept in a MatchCache between
+  runs, so unchanged districts are not rematched. When the ocdid data
+  changes, only the cached matches its changes could affect are dropped.
+
+With --jobs, files are assigned by a pool of worker processes forked once
+  the ocdid index is loaded, so the workers share it. Each file's console
+  messages are printed in file order once it is done, as in a serial run.
+
+Files are only assigned when their staging output could change: an
+  AssignManifest records the collection file, ocdid dataset and code each
+  staging file was written from, and files whose record still holds keep
+  their staging file. --force assigns every file.
+
 Constants:
     Dirs.TEST_DIR -- Directory where raw data is stored
     Dirs.STAGING_DIR -- Directory to place files after matching to ocdids
-    Assign.OCD_PREFIX -- Prefix for all ocdids: 'ocd-division/country:us/'
+    Dirs.MATCH_CACHE -- SQLite file holding cached match results
+    Dirs.MANIFEST -- JSON file recording what each staging file was
+                         assigned from
+    Assign.MATCH_CACHE_SIZE -- maximum number of cached match results
     Assign.ALT_COUNTIES -- alternative county types, LA parish, AK borough
     Assign.REPORT_TEMPLATE -- string template for match reports
+    Assign.CANDIDATES -- number of other candidate ocdids kept for review,
+                             besides the match itself
+    Assign.CANDIDATE_TEMPLATE -- string template for each candidate
+    Assign.SORT_BUFFER -- rows of a file sorted in memory, larger files are
+                              sorted in runs on disk
     Assign.DIST_TYPES -- check for district types in order
     Assign.SPLIT_TYPES -- strings to split types and values on
 """
@@ -60,10 +93,8 @@ def is_exact(prefix_list):
     Returns:
         ocdid -- if found returns the exact match, otherwise returns None
     """
-    test_id = Assign.OCD_PREFIX + '/'.join(prefix_list)
-    if ocdidlib.is_ocdid(test_id):
-        return test_id
-    return None
+    return ocdidlib.path_ocdid(ocdidlib.ancestors(prefix_list),
+                               len(prefix_list))
 
 
 def match_exists(prefix_list, offset):
@@ -79,16 +110,14 @@ def match_exists(prefix_list, offset):
         ocdid -- matching full ocdid if match found, otherwise None
         ratio -- ratio of that exact match (1-100), returns -1 if not found
     """
-    new_prefix = is_exact(prefix_list[:offset])
-    if new_prefix:
-        dist_type, dist_name = prefix_list[offset].split(':')
-        return ocdidlib.match_name(new_prefix, dist_type, dist_name)
-    return None, -1
+    return ocdidlib.match_child(is_exact(prefix_list[:offset]),
+                                prefix_list[offset])
 
 
 def get_full_prefix(prefix_list):
     """When provided a district list, searches a returns to closest ocdid
-    match for that district and the text match ratio
+    match for that district and the text match ratio. See
+    ocdid.OcdidIndex.get_full_prefix
 
     Keyword arguments:
         prefix_list -- list of district values for the ocdid
@@ -97,174 +126,418 @@ def get_full_prefix(prefix_list):
         id_val -- full valid ocdid value
         ratio -- match ratio of district name provided to ocdid name
     """
+    return ocdidlib.get_full_prefix(prefix_list)
 
-    # If the list is empty, it's just the country:us ocdid
-    if len(prefix_list) == 0:
-        return 'ocd-division/country:us', 100
-
-    # NY City/Villages have exceptions since there can be cities, villages,
-    # and towns with the same name in the same county
-    if prefix_list[-1].startswith('place:city_of_') or prefix_list[-1].startswith('place:village_of_'):
-        prefix_list.pop(-2)
-        prefix_list[-1] = prefix_list[-1].replace('city_of_', '')
-        prefix_list[-1] = prefix_list[-1].replace('village_of_', '')
-
-    # Check if there is an immediate exact match. If so, return with a ratio
-    # of 100
-    id_val = is_exact(prefix_list)
-    if id_val:
-        return id_val, 100
-
-    # Check for a closely similar match if no exact match exists
-    if len(prefix_list) > 1:
-        id_val, ratio = match_exists(prefix_list, -1)
-        if ratio >= 91:
-            return id_val, ratio
-
-    # Try removing district values from list to find a match. For example, a
-    # city district might be state->city element instead of state->county->city
-    if len(prefix_list) > 2:
-        id_val, ratio = match_exists(prefix_list, -2)
-        if ratio <= 91:
-            return None, -1
-        prefix_list[-2] = id_val.split('/')[-1]
-
-        id_val = is_exact(prefix_list)
-        if id_val:
-            return id_val, 100
-
-        id_val, ratio = match_exists(prefix_list, -1)
-        if ratio >= 91:
-            return id_val, ratio
-        else:
-            prefix_list.pop(-2)
-            id_val = is_exact(prefix_list)
-            if id_val:
-                return id_val, 100
-            id_val, ratio = match_exists(prefix_list, -1)
-            if ratio >= 91:
-                return id_val, ratio
-    # Return None and -1 for the ratio if no match is found
-    return id_val, -1
-
-
-def is_sub_district(e_district):
+
+# 'ward' logic here to avoid capturing stuff like 'Ward County'
+SUB_DISTRICT = re.compile(r'precinct |district | ward |^ward .{0,3}$', re.DOTALL)
+# every occurrence of every district and split type, overlapping or not
+DISTRICT_WORDS = re.compile('(?=({}))'.format(
+    '|'.join(re.escape(word) for word in Assign.DIST_TYPES + Assign.SPLIT_TYPES)))
+LEGISLATIVE_TYPES = {'house': 'sldl', 'assembly': 'sldl', 'senate': 'sldu'}
+
+
+@lru_cache(maxsize=None)
+def parse_sub_district(e_district):
     """Determines if a district name is describing a lower level district
     than what is provide by the 'Body Represents' info, such as a county
-    commission district, ward, etc.
+    commission district, ward, etc., and splits it into its type and value.
+    The type is the first of Assign.DIST_TYPES in the name, the value what
+    follows the last occurrence of the first of Assign.SPLIT_TYPES in it.
+    Names repeat heavily, so each one is parsed once
 
     Keyword Arguments:
-        e_district -- name of the electoral district
+        e_district -- lower cased name of the electoral district
 
     Returns:
-        True -- if district is a lower level district
-        False -- if 'Body Represents' info sufficient to place district
+        dist_type, value -- formalized district type name and split district
+                                value (council district 3 -> council, 3)
+        None -- if 'Body Represents' info sufficient to place district
     """
-    if 'precinct ' in e_district or 'district ' in e_district:
-        return True
-    # 'ward' logic here to avoid capturing stuff like 'Ward County'
-    elif ' ward ' in e_district or (e_district.startswith('ward ') and len(e_district) < 9):
-        return True
-    else:
-        return False
+    if not SUB_DISTRICT.search(e_district):
+        return None
+    ends = {}
+    for match in DISTRICT_WORDS.finditer(e_district):
+        ends[match.group(1)] = match.end(1)
+    dist_type = next((t for t in Assign.DIST_TYPES if t in ends), None)
+    split = next((s for s in Assign.SPLIT_TYPES if s in ends), None)
+    if dist_type is None or split is None:
+        return None
+    return (LEGISLATIVE_TYPES.get(dist_type, dist_type),
+            e_district[ends[split]:].strip().replace(' ', '_'))
+
+
+def get_prefix_list(row):
+    """Builds the list of district values for a row from its 'Body
+    Represents' fields
 
+    Keyword Arguments:
+        row -- office holder row
 
-def get_sub_district(e_district):
-    """Returns the type value for the lower level district by splitting the
-    district name using the given split values into its type and value
+    Returns:
+        prefix_list -- list of district values for the ocdid
+    """
+    state = row['Body Represents - State'].lower().replace(' ', '_')
+    county = row['Body Represents - County'].lower().replace(' ', '_')
+    muni = row['Body Represents - Muni'].lower().replace(' ', '_')
+
+    prefix_list = []
+    if state:
+        prefix_list.append('state:{}'.format(state))
+    if county:
+        if state in Assign.ALT_COUNTIES:
+            prefix_list.append('{}:{}'.format(Assign.ALT_COUNTIES[state], county))
+        else:
+            prefix_list.append('county:{}'.format(county))
+    if muni:
+        if muni == 'dc':
+            prefix_list.append('district:{}'.format(muni))
+        else:
+            prefix_list.append('place:{}'.format(muni))
+    return prefix_list
+
+
+def match_prefix(prefix_list, cache=None):
+    """get_full_prefix, with results kept in the match cache
 
     Keyword Arguments:
-        e_district -- name of the electoral district
+        prefix_list -- list of district values for the ocdid
+        cache -- MatchCache to use, None to always match
 
     Returns:
-        dist_type -- formalized district type name
-        e_district -- split district value (council district 3 -> value 3)
+        id_val, ratio -- see get_full_prefix
     """
-    # Iterate through main district types, break if matching type found
-    for t in Assign.DIST_TYPES:
-        if t in e_district:
-            if t == 'house' or t == 'assembly':
-                dist_type = 'sldl'
-            elif t == 'senate':
-                dist_type = 'sldu'
-            else:
-                dist_type = t
-            break
-    # Iterate through split types, use type to split district type from value
-    # if found
-    for s in Assign.SPLIT_TYPES:
-        if s in e_district:
-            return dist_type, e_district.split(s)[-1].strip().replace(' ', '_')
+    key = ('prefix',) + tuple(prefix_list)
+    if cache:
+        cached = cache.get(key)
+        if cached:
+            return cached[:2]
+    id_val, ratio = get_full_prefix(prefix_list)
+    if cache:
+        cache.put(key, id_val, ratio)
+    return id_val, ratio
+
+
+def match_sub_districts(full_prefix, dist_type, districts, cache=None):
+    """Matches a group of sub-districts of the same type within a district,
+    first choosing the ocdid district type by the group's size, then
+    matching each district name
+
+    Keyword Arguments:
+        full_prefix -- ocdid of the district containing the sub-districts
+        dist_type -- district type from parse_sub_district
+        districts -- list of sub-district names
+        cache -- MatchCache to use, None to always match
+
+    Returns:
+        matches -- dict of sub-district name -> (ocdid, ratio, candidates),
+                       candidates being the next best (ocdid, ratio)
+    """
+    type_val = ocdidlib.match_type(full_prefix, dist_type, len(districts),
+                                   districts=districts)
+    if not type_val:
+        return dict((d_name, (None, -1, [])) for d_name in districts)
+
+    matches = {}
+    missing = []
+    for d_name in districts:
+        cached = cache.get(('name', full_prefix, type_val, d_name)) if cache else None
+        if cached:
+            matches[d_name] = cached
+        else:
+            missing.append(d_name)
+    # the match comes first, followed by the Assign.CANDIDATES others
+    results = ocdidlib.match_candidates(full_prefix, type_val, missing,
+                                        Assign.CANDIDATES + 1)
+    for d_name, candidates in zip(missing, results):
+        id_val, ratio = candidates[0] if candidates else (None, -1)
+        matches[d_name] = id_val, ratio, candidates[1:]
+        if cache:
+            cache.put(('name', full_prefix, type_val, d_name), id_val, ratio,
+                      candidates[1:])
+    return matches
+
+
+def stale_match(changes):
+    """Returns a function telling whether a cached match could be affected by
+    ocdid dataset changes, for MatchCache.carry_forward. Name matches only
+    depend on the district names of their prefix and type, prefix matches
+    can fall back to other levels of their state so any change in the state
+    affects them
+
+    Keyword Arguments:
+        changes -- dataset changes, see ocdid.diff_ocdid_data
+
+    Returns:
+        is_stale -- function of a match cache key, True if it is affected
+    """
+    buckets = ocdidlib.changed_buckets(changes)
+    regions = ocdidlib.changed_regions(changes)
+
+    def is_stale(key):
+        if key[0] == 'name':
+            return (key[1], key[2]) in buckets
+        return len(key) > 1 and (key[1] in regions or None in regions)
+    return is_stale
+
+
+def set_match(row, id_val, ratio, candidates=()):
+    """Writes a match result to a row's OCDID, ocdid_report and
+    ocdid_candidates fields
+    """
+    row['OCDID'] = id_val or ''
+    row['ocdid_report'] = Assign.REPORT_TEMPLATE.format(row['Electoral District'], id_val, ratio)
+    row['ocdid_candidates'] = '; '.join(Assign.CANDIDATE_TEMPLATE.format(*c)
+                                        for c in candidates)
 
 
 cur.execute('SELECT ocdid FROM electoral_districts')
 ocdids_in_db = set(row['ocdid'] for row in cur.fetchall())
 conn.commit()
 
-def assign_ids(f):
-    """Function that does the bulk of the processing. Definitely too long and
-    needs to be split out to smaller functions, oh well. Outputs the
-    matched data to a staging folder
+def read_rows(path):
+    """Reads the rows of a collection file one at a time, with their OCDID
+    lowercased
+
+    Returns:
+        fields -- the file's field names
+        rows -- generator of the rows, as dicts
+    """
+    r = open(path, 'r', encoding='utf-16')
+    reader = DictReader(r, dialect='excel-tab')
+    fields = reader.fieldnames
+
+    def rows():
+        with r:
+            for row in reader:
+                row['OCDID'] = row['OCDID'].lower()
+                yield row
+    return fields, rows()
+
+
+def match_file(path, cache=None):
+    """Matches the districts of the rows without an ocdid, grouping
+    sub-districts (wards, council districts, etc.) by the district they are
+    in. Only the distinct districts are kept, not the rows
+
+    Keyword Arguments:
+        path -- collection file to match
+        cache -- MatchCache for match results, None to always match
+
+    Returns:
+        prefixes -- dict of get_prefix_list tuple -> (ocdid, ratio)
+        sub_districts -- dict of (ocdid, district type) -> dict of
+                             sub-district name -> (ocdid, ratio, candidates)
+    """
+    prefixes = {}
+    unmatched = {}
+    for row in read_rows(path)[1]:
+        if row['OCDID'] != '':
+            continue
+        ocdid_key = tuple(get_prefix_list(row))
+        if ocdid_key not in prefixes:
+            prefixes[ocdid_key] = match_prefix(ocdid_key, cache)
+        full_prefix, ratio = prefixes[ocdid_key]
+
+        ed = row['Electoral District'].lower()
+        sub_district = parse_sub_district(ed) if full_prefix else None
+        if sub_district:
+            d_type, d_name = sub_district
+            unmatched.setdefault((full_prefix, d_type), {})[d_name] = None
+
+    sub_districts = {}
+    for (full_prefix, d_type), districts in unmatched.items():
+        sub_districts[(full_prefix, d_type)] = match_sub_districts(
+            full_prefix, d_type, list(districts), cache)
+    return prefixes, sub_districts
+
+
+def assign_ids(f, match=False, cache=None):
+    """Writes the rows of a collection file, sorted by Person UUID, to the
+    staging folder, optionally matching the rows without an ocdid. The file
+    is streamed, read a second time to match its districts, so only the
+    distinct districts and a bounded number of rows (Assign.SORT_BUFFER) are
+    held in memory
 
     Keyword Arguments:
         f -- name of the file to process
+        match -- match rows without an OCDID, rather than only reporting them
+        cache -- MatchCache for match results, None to always match
     """
     test_file_path = os.path.join(Dirs.TEST_DIR, f)
     staging_file_path = os.path.join(Dirs.STAGING_DIR, f)
 
-    with open(test_file_path, 'r', encoding='utf-16') as r, \
-         open(staging_file_path, 'w', encoding='utf-16') as w:
-        reader = DictReader(r, dialect='excel-tab')
-        rows = list(reader)
-        fields = reader.fieldnames
-        # ocdid_report is not included sometimes, and additional fields are
-        # occassionally added.
-        if 'ocdid_report' not in fields:
-            fields.append('ocdid_report')
-        writer = DictWriter(w, fieldnames=fields, dialect='excel-tab')
-        writer.writeheader()
-
-        ocdid_vals = {}
-        unmatched = {}
-        matched = []
-
-        for row in list(rows):
-            row['OCDID'] = row['OCDID'].lower()
-            ocdid = row['OCDID']
-            if ocdid == '':
+    if match:
+        prefixes, sub_districts = match_file(test_file_path, cache)
+
+    fields, rows = read_rows(test_file_path)
+    # ocdid_report is not included sometimes, and additional fields are
+    # occassionally added.
+    if 'ocdid_report' not in fields:
+        fields.append('ocdid_report')
+    # candidates go before the report, which is kept as the last field
+    if match and 'ocdid_candidates' not in fields:
+        fields.insert(fields.index('ocdid_report'), 'ocdid_candidates')
+
+    def matched_rows():
+        for row in rows:
+            if match and row['OCDID'] == '':
+                full_prefix, ratio = prefixes[tuple(get_prefix_list(row))]
+                ed = row['Electoral District'].lower()
+                sub_district = parse_sub_district(ed) if full_prefix else None
+                if sub_district:
+                    d_type, d_name = sub_district
+                    matches = sub_districts[(full_prefix, d_type)]
+                    set_match(row, *matches[d_name])
+                else:
+                    set_match(row, full_prefix, ratio)
+            if row['OCDID'] == '':
                 message = '{} / {} ({}) has no OCDID.'
                 print(message.format(row['Person UUID'],
                                      row['Electoral District'],
                                      row['State']))
-                rows.remove(row)
+            yield row
+
+    with open(staging_file_path, 'w', encoding='utf-16') as w:
+        writer = DictWriter(w, fieldnames=fields, dialect='excel-tab')
+        writer.writeheader()
+        for row in sorted_stream(matched_rows(), itemgetter('Person UUID'),
+                                 Assign.SORT_BUFFER):
+            try:
+                writer.writerow(row)
+            except ValueError:
+                print(row)
+                raise
+
 
-            matched.append(row)
+_match = False
+_cache = None
+
+
+def _init_worker(match, cache_args):
+    """Opens the worker's own connection to the match cache. Matching uses
+    the index loaded before the fork rather than the parent's connection to
+    an ocdid service
+    """
+    global _match, _cache
+    _match = match
+    if ocdidlib.service:
+        ocdidlib.service.close()
+        ocdidlib.service = None
+    if cache_args:
+        _cache = MatchCache(*cache_args, defer=True)
+
+
+def _assign_file(filename):
+    """assign_ids in a worker process
+
+    Returns:
+        output -- console messages of the file
+        updates -- match cache updates, see MatchCache.take_updates
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        assign_ids(filename, _match, _cache)
+    return output.getvalue(), _cache.take_updates() if _cache else None
+
+
+def assign_files(filenames, match=False, cache=None, jobs=1):
+    """Runs assign_ids over each file, one at a time or in a process pool
+
+    Keyword Arguments:
+        filenames -- files in Dirs.TEST_DIR to process
+        match -- match rows without an OCDID, see assign_ids
+        cache -- MatchCache for match results, None to always match
+        jobs -- number of worker processes, 1 to process files in this one
+    """
+    if jobs <= 1:
+        for filename in filenames:
+            print(filename)
+            assign_ids(filename, match, cache)
+        return
+
+    if match:
+        ocdidlib.index.prepare()
+    cache_args = (Dirs.MATCH_CACHE, cache.dataset, cache.max_size) if cache else None
+    pool = multiprocessing.get_context('fork').Pool(jobs, _init_worker,
+                                                    (match, cache_args))
+    try:
+        results = pool.imap(_assign_file, filenames)
+        for filename, (output, updates) in zip(filenames, results):
+            print(filename)
+            sys.stdout.write(output)
+            if updates:
+                cache.merge(updates)
+    finally:
+        pool.close()
+        pool.join()
 
-        matched.sort(key=lambda x: x['Person UUID'])
-        try:
-            writer.writerows(matched)
-        except ValueError:
-            print(matched[0])
-            print([match for match in matched if None in list(match)][0])
-            raise
 
 def main():
     """Pull in file list and assign id's to each file. Accepts the -s
     command line option to only assign data to a specific state or file
-    abbreviation ('SL', 'SW', 'City', state abbreviations, etc.)
+    abbreviation ('SL', 'SW', 'City', state abbreviations, etc.), -m to
+    match rows without an OCDID, -j to assign several files at once, and
+    --force to assign files whose staging output is current
     """
 
     usage = 'Assign ocdids to office holders'
     parser = ArgumentParser(usage=usage)
     parser.add_argument('-s', action='store', dest='state',
                         default=None, help='Abbreviation of state to assign')
+    parser.add_argument('-m', '--match', action='store_true', dest='match',
+                        help='Match rows that have no OCDID')
+    parser.add_argument('-j', '--jobs', action='store', dest='jobs', type=int,
+                        default=1, help='Number of files to assign at once')
+    parser.add_argument('--force', action='store_true', dest='force',
+                        help='Assign files even when unchanged')
     args = parser.parse_args()
 
     filenames = [filename for filename in sorted(listdir(Dirs.TEST_DIR))
                  if filename.endswith('.txt')]
-    for filename in filenames:
-            print(filename)
-            assign_ids(filename)
+    cache = None
+    dataset = None
+    if args.match:
+        # matches are keyed on the alias table and prefix config as well as
+        # the ocdid data, editing either starts the cache over
+        dataset = ocdidlib.index.match_checksum
+        cache = MatchCache(Dirs.MATCH_CACHE, dataset, Assign.MATCH_CACHE_SIZE)
+        changes = ocdidlib.index.changes
+        if changes:
+            kept, dropped = cache.carry_forward(
+                ocdidlib.match_checksum(changes['previous']),
+                stale_match(changes))
+            if kept or dropped:
+                print('Match cache: kept {} matches from the previous ocdid '
+                      'data, dropped {} affected by its changes'.format(
+                          kept, dropped))
+
+    # output assigned without matching is recorded with no dataset
+    manifest = AssignManifest(Dirs.MANIFEST, dataset,
+                              code_version([__file__, Ocdid.ALIASES]))
+    for filename in manifest.drop_missing(filenames):
+        staging_file_path = os.path.join(Dirs.STAGING_DIR, filename)
+        if os.path.exists(staging_file_path):
+            print('Removing {}, its collection file is gone'.format(
+                staging_file_path))
+            os.remove(staging_file_path)
+    paths = dict((filename, (os.path.join(Dirs.TEST_DIR, filename),
+                             os.path.join(Dirs.STAGING_DIR, filename)))
+                 for filename in filenames)
+    assigned = [filename for filename in filenames
+                if args.force or not manifest.is_current(filename,
+                                                         *paths[filename])]
+    if len(assigned) < len(filenames):
+        print('Keeping the staging output of {} unchanged files'.format(
+            len(filenames) - len(assigned)))
+
+    assign_files(assigned, args.match, cache, args.jobs)
+    for filename in assigned:
+        manifest.record(filename, *paths[filename])
+    manifest.close()
+    if cache:
+        print(cache.stats())
+        cache.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+import random
+import time
+import ocdid as ocdidlib
+from argparse import ArgumentParser
+from ocdid_config import Match, Ocdid
+
+"""
+Benchmark of score pruning (Match.PRUNE) in the ocdid matching functions.
+  Runs the same match_names and name_search workload with pruning off and on,
+  counting calls to the scorer, and checks that both give identical results
+
+Sample names are district names from the dataset itself, some with a typo,
+  so the benchmark reflects matching against the real ocdid csv
+
+Requirements:
+Python3
+ocdid module (+ module requirements)
+
+Constants from config:
+Ocdid.URL -- default ocdid csv file or url
+"""
+
+
+class CountingScorer(object):
+    """Wraps the ocdid module scorer, counting calls"""
+
+    def __init__(self, scorer):
+        self.scorer = scorer
+        self.calls = 0
+
+    def __call__(self, query, choice):
+        self.calls += 1
+        return self.scorer(query, choice)
+
+
+def add_typo(name, rand):
+    """Drops, doubles or swaps a character of a name, or leaves it as is"""
+    if len(name) < 3:
+        return name
+    i = rand.randrange(len(name) - 1)
+    return rand.choice([name,
+                        name[:i] + name[i+1:],
+                        name[:i] + name[i] + name[i:],
+                        name[:i] + name[i+1] + name[i] + name[i+2:]])
+
+
+def build_workload(index, samples, seed):
+    """Picks the sample names
+
+    Keyword arguments:
+    index -- OcdidIndex to sample from
+    samples -- number of match_names groups and of name_search names
+    seed -- random seed, so runs are comparable
+
+    Returns:
+    groups -- list of (ocdid_prefix, district_type, [names]) for match_names
+    searches -- list of names for name_search
+
+    """
+    rand = random.Random(seed)
+    ocdids = index.ocdids
+    prefixes = sorted(ocdids)
+    groups = []
+    searches = []
+    for i in range(samples):
+        prefix = rand.choice(prefixes)
+        dist_type = rand.choice(sorted(ocdids[prefix]))
+        names = ocdids[prefix][dist_type]
+        groups.append((prefix, dist_type,
+                       [add_typo(rand.choice(names), rand) for j in range(5)]))
+        searches.append(add_typo(rand.choice(names), rand))
+    return groups, searches
+
+
+def run(index, groups, searches, prune):
+    """Runs the workload
+
+    Returns:
+    results -- every match result, for comparing runs
+    calls -- dict of function -> number of scorer calls
+    seconds -- dict of function -> time taken
+
+    """
+    Match.PRUNE = prune
+    counter = CountingScorer(ocdidlib.score)
+    ocdidlib.score = counter
+    results = []
+    calls = {}
+    seconds = {}
+    try:
+        start = time.time()
+        for prefix, dist_type, names in groups:
+            results.append(index.match_names(prefix, dist_type, names))
+        calls['match_names'] = counter.calls
+        seconds['match_names'] = time.time() - start
+
+        counter.calls = 0
+        start = time.time()
+        for name in searches:
+            results.append(index.name_search(name))
+        calls['name_search'] = counter.calls
+        seconds['name_search'] = time.time() - start
+    finally:
+        ocdidlib.score = counter.scorer
+    return results, calls, seconds
+
+
+def main():
+    usage = 'Count the scorer calls saved by Match.PRUNE'
+    parser = ArgumentParser(usage=usage)
+    parser.add_argument('-u', '--url', action='store', dest='url',
+                        default=Ocdid.URL, help='ocdid csv file or url')
+    parser.add_argument('-n', '--samples', action='store', dest='samples',
+                        type=int, default=500, help='number of sample names')
+    parser.add_argument('-s', '--seed', action='store', dest='seed',
+                        type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    index = ocdidlib.OcdidIndex.from_source(args.url, None)
+    groups, searches = build_workload(index, args.samples, args.seed)
+
+    full_results, full_calls, full_seconds = run(index, groups, searches, False)
+    results, calls, seconds = run(index, groups, searches, True)
+
+    print('{:<12} {:>12} {:>12} {:>8} {:>10} {:>10}'.format(
+        '', 'calls', 'pruned', 'saved', 'seconds', 'pruned'))
+    for name in ('match_names', 'name_search'):
+        saved = 1 - float(calls[name]) / full_calls[name] if full_calls[name] else 0
+        print('{:<12} {:>12} {:>12} {:>7.1%} {:>10.2f} {:>10.2f}'.format(
+            name, full_calls[name], calls[name], saved, full_seconds[name],
+            seconds[name]))
+    if results != full_results:
+        raise Exception('Error: pruned results differ from full scoring')
+    print('Results identical')
+
+
+if __name__ == '__main__':
+    main()
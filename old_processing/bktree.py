@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+BK-tree (Burkhard-Keller tree) over strings, for finding every stored string
+  within an edit distance of a query without comparing against all of them.
+  Each child hangs off its parent by its distance to the parent, so by the
+  triangle inequality a search only descends into children whose distance
+  is within the search distance of the query's own distance to the parent
+
+Requirements:
+Python3
+python-Levenshtein (optional, faster distances)
+"""
+
+try:
+    from Levenshtein import distance as fast_levenshtein
+except ImportError:
+    fast_levenshtein = None
+
+
+class BKTree(object):
+    """Strings indexed by Levenshtein distance"""
+
+    def __init__(self, words=()):
+        """Keyword arguments:
+        words -- strings to add to the tree
+        """
+        # a node is [word, {distance: child node}]
+        self._root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        """Adds a string, ignoring duplicates"""
+        if self._root is None:
+            self._root = [word, {}]
+            return
+        node = self._root
+        while True:
+            distance = levenshtein(word, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [word, {}]
+                return
+            node = child
+
+    def search(self, word, max_distance):
+        """Finds the stored strings within an edit distance of a string
+
+        Keyword arguments:
+        word -- string to search for
+        max_distance -- largest edit distance returned
+
+        Returns:
+        matches -- sorted list of (distance, string), closest first
+
+        """
+        matches = []
+        if self._root is None:
+            return matches
+        nodes = [self._root]
+        while nodes:
+            node_word, children = nodes.pop()
+            distance = levenshtein(word, node_word)
+            if distance <= max_distance:
+                matches.append((distance, node_word))
+            for child_distance, child in children.items():
+                if abs(child_distance - distance) <= max_distance:
+                    nodes.append(child)
+        return sorted(matches)
+
+
+def levenshtein(a, b):
+    """Returns the number of single character insertions, deletions and
+    substitutions needed to turn a into b
+    """
+    if fast_levenshtein:
+        return fast_levenshtein(a, b)
+    # sibling ocdid segments mostly share a type and differ in a few
+    # characters, so only the differing middle goes through the table
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start and \
+            a[-1 - end] == b[-1 - end]:
+        end += 1
+    a = a[start:len(a) - end]
+    b = b[start:len(b) - end]
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
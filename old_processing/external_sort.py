@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+import heapq
+import pickle
+import tempfile
+
+"""
+Sorting of item streams too large to hold in memory. Items are sorted in
+  runs of a bounded size, the runs past the first spilled to temporary
+  files, and the runs merged back as they are read. The order is the one
+  sorted() gives, ties included, so switching between the in memory and the
+  on disk sort never changes the output
+
+Requirements:
+Python3
+"""
+
+
+def sorted_stream(items, key, max_items):
+    """Sorts a stream of items, holding at most max_items in memory at once
+
+    Keyword arguments:
+    items -- iterable of picklable items
+    key -- sort key function, as for sorted
+    max_items -- number of items sorted in memory before a run is written
+                     to disk
+
+    Returns:
+    items -- generator of the items in sorted(items, key=key) order
+
+    """
+    runs = []
+    run = []
+    try:
+        for item in items:
+            run.append(item)
+            if len(run) >= max_items:
+                runs.append(write_run(sorted(run, key=key)))
+                run = []
+        run.sort(key=key)
+        # merge keeps the order of the runs on ties, the runs being in
+        # input order that is sorted's stable order
+        yield from heapq.merge(*[read_run(f) for f in runs], run, key=key)
+    finally:
+        for f in runs:
+            f.close()
+
+
+def write_run(run):
+    """Writes a sorted run to a temporary file, removed once closed"""
+    f = tempfile.TemporaryFile()
+    # each item is pickled on its own, a shared pickler and unpickler would
+    # remember every item they handled
+    for item in run:
+        pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+
+def read_run(f):
+    """Reads the items of a run back, one at a time"""
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
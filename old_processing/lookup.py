@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+import cmd
+import os
+import ocdid as ocdidlib
+from argparse import ArgumentParser
+from ocdid_config import Ocdid
+
+"""
+Command line district lookups against the ocdid snapshot, for reviewing
+  matches by hand. A single lookup is run from the command line arguments,
+  with no arguments an interactive shell keeps the index loaded between
+  lookups:
+
+  python lookup.py browse state:ca/county:marin
+  python lookup.py search marin
+  python lookup.py type county marin
+  python lookup.py resolve state:ca/county:marn
+  python lookup.py
+
+Ocdids can be given in full or starting below the country
+  ('state:ca/county:marin'). An existing snapshot is used as is, run ocdid.py
+  to rebuild it after the ocdid data changes
+
+Requirements:
+Python3
+ocdid module (+ module requirements)
+
+Constants from config:
+Ocdid.SNAPSHOT -- ocdid snapshot, built from Ocdid.URL if missing or outdated
+Ocdid.URL -- ocdid csv file or url
+"""
+
+
+def full_ocdid(value):
+    """Adds the country ocdid to an ocdid given below it"""
+    value = value.strip().strip('/').lower()
+    if not value:
+        return Ocdid.COUNTRY
+    if value.startswith('ocd-division/'):
+        return value
+    return '{}/{}'.format(Ocdid.COUNTRY, value)
+
+
+class LookupShell(cmd.Cmd):
+    """Lookup commands, run one at a time or as an interactive shell"""
+    intro = 'ocdid lookup, type help or ? to list commands'
+    prompt = '(ocdid) '
+
+    def __init__(self, index):
+        """Keyword arguments:
+        index -- OcdidIndex to look districts up in
+        """
+        cmd.Cmd.__init__(self)
+        self.index = index
+
+    def do_browse(self, arg):
+        """browse [OCDID]: lists the district types and names below an
+        ocdid, the country if none is given"""
+        ocdid = full_ocdid(arg)
+        node = self.index.store.node(ocdid)
+        if node is None:
+            print('{} not found'.format(ocdid))
+            self.print_suggestions(ocdid)
+        elif node not in self.index.store.parent_buckets:
+            print('{} has no districts below it'.format(ocdid))
+        else:
+            print(ocdid)
+            self.index.print_subdistrict_data(ocdid)
+
+    def do_search(self, arg):
+        """search NAME: searches every district type for a name"""
+        self.print_matches(self.index.name_search(arg))
+
+    def do_type(self, arg):
+        """type TYPE NAME: searches districts of a type for a name. TYPE is
+        an ocdid district type (council_district) or a general one (city,
+        council)"""
+        words = arg.split(None, 1)
+        if len(words) < 2:
+            print('usage: type TYPE NAME')
+            return
+        self.print_matches(self.index.type_name_search(*words))
+
+    def do_resolve(self, arg):
+        """resolve OCDID: checks an ocdid exists, giving the official ocdid
+        for exceptions and the closest ocdids for unknown ones"""
+        ocdid = full_ocdid(arg)
+        same_as = self.index.get_exception(ocdid)
+        if same_as:
+            print('{} is an exception, official ocdid {}'.format(ocdid,
+                                                                 same_as))
+        elif self.index.is_ocdid(ocdid):
+            print('{} is current'.format(ocdid))
+        else:
+            print('{} not found'.format(ocdid))
+            self.print_suggestions(ocdid)
+
+    def do_quit(self, arg):
+        """quit: leaves the shell"""
+        return True
+
+    do_EOF = do_quit
+
+    def emptyline(self):
+        """An empty line does nothing, rather than repeating the last
+        command"""
+
+    def print_matches(self, match_list):
+        """Prints name search results"""
+        if not match_list:
+            print('No matches')
+        for ratio, ocdid in match_list:
+            print('  {:>3} {}'.format(ratio, ocdid))
+
+    def print_suggestions(self, ocdid):
+        """Prints the current ocdids closest to an unknown one"""
+        for distance, suggestion in self.index.suggest(ocdid):
+            print('  did you mean {}'.format(suggestion))
+
+
+def load_index(snapshot, url):
+    """Opens the snapshot as is when it is readable, otherwise (re)builds it"""
+    if snapshot and os.path.exists(snapshot):
+        index = ocdidlib.OcdidIndex.from_snapshot(snapshot)
+        try:
+            index.load()
+            return index
+        except IOError:
+            # written by an older version of the ocdid module
+            pass
+    index = ocdidlib.OcdidIndex.from_source(url, snapshot)
+    index.load()
+    return index
+
+
+def main():
+    usage = 'lookup.py [options] [browse|search|type|resolve ARGS...]'
+    parser = ArgumentParser(usage=usage,
+                            description='Look up ocdids, with no command '
+                                        'starts an interactive shell')
+    parser.add_argument('command', nargs='*', help='lookup to run')
+    parser.add_argument('-o', '--snapshot', action='store', dest='snapshot',
+                        default=Ocdid.SNAPSHOT, help='ocdid snapshot file')
+    parser.add_argument('-u', '--url', action='store', dest='url',
+                        default=Ocdid.URL,
+                        help='ocdid csv file or url, if there is no snapshot')
+    args = parser.parse_args()
+
+    shell = LookupShell(load_index(args.snapshot, args.url))
+    if args.command:
+        shell.onecmd(' '.join(args.command))
+    else:
+        shell.cmdloop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+import json
+import sqlite3
+import time
+
+"""
+Persistent cache of ocdid match results, kept in a local SQLite file between
+  runs. Entries are keyed by the normalized match input (a tuple of district
+  values) and the checksum of the ocdid dataset they were matched against
+  (ocdid.match_checksum, which also covers the alias table), so a new ocdid
+  dataset never returns stale matches. The cache is bounded to
+  a maximum number of entries, evicting entries from other datasets first
+  and then the least recently used.
+
+Worker processes matching in parallel open the cache file with defer set.
+  They read it as usual but keep their new entries in memory, handing them
+  to the process owning the cache (see take_updates and merge), so only one
+  process ever writes to the file.
+
+Requirements:
+Python3
+"""
+
+
+class MatchCache(object):
+    """Cache of (ocdid, ratio, candidates) match results for one ocdid
+    dataset
+
+    Attributes:
+    hits -- number of lookups found in the cache
+    misses -- number of lookups not found in the cache
+    """
+
+    def __init__(self, path, dataset, max_size, defer=False):
+        """Keyword arguments:
+        path -- SQLite file to store the cache in, created if missing
+        dataset -- checksum of the ocdid dataset matches are made against
+        max_size -- maximum number of entries kept when the cache is closed
+        defer -- keep new entries in memory rather than writing them
+        """
+        self.dataset = dataset
+        self.max_size = max_size
+        self.defer = defer
+        self.hits = 0
+        self.misses = 0
+        self._used = set()
+        self._pending = []
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS matches ('
+                          'key TEXT, dataset TEXT, ocdid TEXT, ratio INTEGER, '
+                          'used REAL, candidates TEXT, '
+                          'PRIMARY KEY (key, dataset))')
+        columns = [row[1] for row in
+                   self.conn.execute('PRAGMA table_info(matches)')]
+        if 'candidates' not in columns:
+            self.conn.execute('ALTER TABLE matches ADD COLUMN candidates TEXT')
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(values):
+        """Serializes a tuple of match inputs into a cache key"""
+        return json.dumps(list(values))
+
+    def get(self, values):
+        """Looks up a cached match
+
+        Keyword arguments:
+        values -- tuple of the normalized match inputs
+
+        Returns:
+        (ocdid, ratio, candidates) -- if cached for this dataset
+        None -- if not cached
+
+        """
+        key = self.make_key(values)
+        row = self.conn.execute('SELECT ocdid, ratio, candidates FROM matches '
+                                'WHERE key = ? AND dataset = ?',
+                                (key, self.dataset)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.add(key)
+        candidates = [tuple(c) for c in json.loads(row[2] or '[]')]
+        return row[0], row[1], candidates
+
+    def put(self, values, ocdid, ratio, candidates=()):
+        """Stores a match result
+
+        Keyword arguments:
+        values -- tuple of the normalized match inputs
+        ocdid -- matched ocdid, None if no match was found
+        ratio -- match ratio, -1 if no match was found
+        candidates -- list of other (ocdid, ratio) the inputs could match
+
+        """
+        entry = (self.make_key(values), self.dataset, ocdid, ratio,
+                 time.time(), json.dumps(list(candidates)))
+        if self.defer:
+            self._pending.append(entry)
+        else:
+            self._insert([entry])
+
+    def _insert(self, entries):
+        """Writes (key, dataset, ocdid, ratio, used, candidates) entries"""
+        self.conn.executemany('INSERT OR REPLACE INTO matches '
+                              '(key, dataset, ocdid, ratio, used, candidates) '
+                              'VALUES (?, ?, ?, ?, ?, ?)', entries)
+
+    def take_updates(self):
+        """Hands over what a deferred cache has done since the last call
+
+        Returns:
+        updates -- new entries, used keys, hits and misses, for merge
+
+        """
+        updates = self._pending, self._used, self.hits, self.misses
+        self._pending = []
+        self._used = set()
+        self.hits = 0
+        self.misses = 0
+        return updates
+
+    def merge(self, updates):
+        """Writes the updates a deferred cache handed over with take_updates"""
+        pending, used, hits, misses = updates
+        self._insert(pending)
+        self._used.update(used)
+        self.hits += hits
+        self.misses += misses
+
+    def carry_forward(self, previous, is_stale):
+        """Moves the entries matched against a previous ocdid dataset over to
+        this one, dropping the ones the dataset changes could affect
+
+        Keyword arguments:
+        previous -- checksum of the previous ocdid dataset
+        is_stale -- function of an entry's match inputs (as a list), True if
+                        the entry has to be matched again
+
+        Returns:
+        kept, dropped -- number of entries moved over and dropped
+
+        """
+        kept = 0
+        dropped = 0
+        rows = self.conn.execute('SELECT key FROM matches WHERE dataset = ?',
+                                 (previous,)).fetchall()
+        for (key,) in rows:
+            if is_stale(json.loads(key)):
+                dropped += 1
+            else:
+                # an entry already matched against this dataset is kept
+                self.conn.execute('UPDATE OR IGNORE matches SET dataset = ? '
+                                  'WHERE key = ? AND dataset = ?',
+                                  (self.dataset, key, previous))
+                kept += 1
+        self.conn.execute('DELETE FROM matches WHERE dataset = ?', (previous,))
+        self.conn.commit()
+        return kept, dropped
+
+    def close(self):
+        """Marks this run's hits as recently used, evicts entries over
+        max_size, and writes the cache to disk
+        """
+        now = time.time()
+        self.conn.executemany('UPDATE matches SET used = ? '
+                              'WHERE key = ? AND dataset = ?',
+                              ((now, key, self.dataset) for key in self._used))
+        count = self.conn.execute('SELECT COUNT(*) FROM matches').fetchone()[0]
+        if count > self.max_size:
+            self.conn.execute('DELETE FROM matches WHERE rowid IN ('
+                              'SELECT rowid FROM matches '
+                              'ORDER BY dataset = ?, used LIMIT ?)',
+                              (self.dataset, count - self.max_size))
+        self.conn.commit()
+        self.conn.close()
+
+    def stats(self):
+        """Returns a printable summary of cache usage"""
+        return 'Match cache: {} hits, {} misses'.format(self.hits, self.misses)
@@ -1,10 +1,24 @@
 #!/usr/bin/env python
-import requests
+import bisect
+import hashlib
+import heapq
 import io
-from fuzzywuzzy import fuzz, process
-from operator import itemgetter
+import math
+import os
+import pickle
+import re
+import zlib
+from argparse import ArgumentParser
+from array import array
+from functools import lru_cache, partial
+from fuzzywuzzy import fuzz
+from fuzzywuzzy.utils import full_process
 from csv import DictReader
+from operator import itemgetter
 from ocdid_config import Match, Ocdid
+from ocdid_store import OcdidStore
+from bktree import BKTree
+from remote_file import fetch
 import unicodedata
 
 """
@@ -12,276 +26,1626 @@ Module to parse official ocdid data accept district data, and attempt to
   match given data to official ocdids. Provides ratios data for inexact
   matches and a list of closest matches when searching
 
+The ocdid data is held by an OcdidIndex, which loads lazily the first time it
+  is used. The module level functions are thin wrappers around a default index
+  built from Ocdid.URL, so importing this module is free for scripts that
+  never match anything. Other indexes (a different dataset version, a
+  database table, a snapshot) can be built with the OcdidIndex.from_* methods
+  and used side by side.
+
+When an ocdid_service is listening on Ocdid.SERVICE at import, the module
+  level matching functions are answered by it instead, skipping the load (see
+  use_service). Only the ocdid csv is read, to check that the service matches
+  against the same data. The default index is still used for the rest
+
 Requirements:
-Python2.7
+Python3
 Requests
 fuzzywuzzy
 
 Constants from config:
 Ocdid.URL -- location to pull ocdid data from, either a file or url
+Ocdid.DOWNLOAD -- local copy of the ocdid data when pulled from a url
+Ocdid.DOWNLOAD_MAX_AGE -- seconds a checked local copy is used without
+                              revalidating it against the url
 Ocdid.NONCURRENT_DIST -- set of obsolete or future districts
+Ocdid.SNAPSHOT -- prebuilt copy of the parsed ocdid data, rebuilt whenever
+                      the ocdid data, NONCURRENT_DIST, Match.NGRAM or
+                      Match.NUMBERED_TYPES changes
+Ocdid.SNAPSHOT_VERSION -- bumped when the snapshot layout changes
+Ocdid.SERVICE -- socket of a running ocdid_service, None to never use one
+Ocdid.ALIASES -- optional csv of curated alias ocdids and the ocdid each
+                     stands for
 Match.RATIO -- lowest valid match ratio accepted
 Match.LIMIT -- maximum number of matched values returned
 Match.CONVERSIONS -- conversions for general district types to valid ocd types
+Match.NGRAM -- n-gram length for the name search index
+Match.NGRAM_OVERLAP -- share of a search name's n-grams a district name needs
+                           to be scored, names sharing fewer are never
+                           scored so the search is approximate
+Match.PRUNE -- skip scoring names whose length rules out a better score
+Match.SUGGEST_LIMIT -- maximum number of suggestions for an unknown ocdid
+Match.SUGGEST_DISTANCE -- maximum edit distance of those suggestions
+Match.NAME_PREFIXES -- name prefixes by district type that are dropped from
+                           a name along with its parent district ('city of')
+Match.NUMBERED_TYPES -- district types matched by number rather than by
+                            name when both the name and districts are
+                            numbered (see district_number)
 """
 
+# process.extractOne's default scorer, for choices that are already processed
+score = partial(fuzz.WRatio, full_process=False)
 
-def is_ocdid(ocdid):
-    """Check whether given ocdid is contained in the official ocdid list
+# a normalized district number: '3', '03', '3rd', '3a' and '3 a'
+NUMBER = re.compile(r'^0*(\d+)(?:st|nd|rd|th)?(?: ?([a-z]))?$')
+ROMAN = re.compile(r'^x{0,3}(?:ix|iv|v?i{0,3})$')
+ROMAN_VALUES = {'i': 1, 'v': 5, 'x': 10}
+
+
+class OcdidIndex(object):
+    """Official ocdid data and the matching functions that use it. Data is
+    read by the loader on first access, so creating an index is cheap
+
+    Matching works on the compact OcdidStore. The string based views below
+    are built from it on first access, for callers that use them directly
+
+    Attributes (loaded on first use):
+    store -- OcdidStore holding the dataset
+    ocdid_set -- set of all current ocdids
+    exceptions -- dict of ocdids to their official 'sameAs' ocdid
+    ocdids -- dict of ocdid_prefix -> district_type -> [names]
+    checksum -- checksum of the dataset the index was loaded from
+    match_checksum -- checksum of the dataset and the other matching inputs,
+                          see match_checksum
+    changes -- changes since the previous snapshot's dataset, see
+                   diff_ocdid_data
+    """
+
+    def __init__(self, loader, checksummer=None):
+        """Keyword arguments:
+        loader -- function returning (checksum, data) where data is a
+                      build_ocdid_data dict, called once on first use
+        checksummer -- function returning the dataset checksum without
+                           loading the data, None to load it for the checksum
+        """
+        self._loader = loader
+        self._checksummer = checksummer
+        self._data = None
+        self._checksum = None
+        self._views = {}
+        self._children = None
+        self._segment_trees = {}
+        self._aliases = None
+
+    @classmethod
+    def from_source(cls, url=Ocdid.URL, snapshot=Ocdid.SNAPSHOT):
+        """Index over a file or url, whichever 'url' points at"""
+        if 'http' in url:
+            return cls.from_url(url, snapshot)
+        return cls.from_file(url, snapshot)
+
+    @classmethod
+    def from_file(cls, path, snapshot=None):
+        """Index over an ocdid csv file, optionally cached in a snapshot"""
+        def loader():
+            with open(path, 'rb') as f:
+                return load_ocdid_data(f.read(), snapshot)
+
+        def checksummer():
+            with open(path, 'rb') as f:
+                return dataset_checksum(f.read())
+        return cls(loader, checksummer)
+
+    @classmethod
+    def from_url(cls, url, snapshot=None, download=Ocdid.DOWNLOAD,
+                 max_age=Ocdid.DOWNLOAD_MAX_AGE):
+        """Index over an ocdid csv url, optionally cached in a snapshot. The
+        csv is downloaded to a local copy that is only fetched again when
+        the url's copy changes (see remote_file.fetch)
+        """
+        def loader():
+            path = fetch(url, download, max_age)
+            with open(path, 'rb') as f:
+                return load_ocdid_data(f.read(), snapshot)
+
+        def checksummer():
+            path = fetch(url, download, max_age)
+            with open(path, 'rb') as f:
+                return dataset_checksum(f.read())
+        return cls(loader, checksummer)
+
+    @classmethod
+    def from_cursor(cls, cursor, query):
+        """Index over a database table. The query must select the id and
+        sameAs (official ocdid) values, in that order
+        """
+        def loader():
+            cursor.execute(query)
+            rows = []
+            checksum = hashlib.sha1()
+            for row in cursor.fetchall():
+                if hasattr(row, 'values'):
+                    row = list(row.values())
+                id_val, same_as = row[0], row[1] or ''
+                rows.append((id_val, same_as))
+                checksum.update('{},{}\n'.format(id_val, same_as).encode('utf-8'))
+            return checksum.hexdigest(), build_ocdid_data(rows)
+        return cls(loader)
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """Index over a snapshot file as is, without checking it against the
+        ocdid data it was built from
+        """
+        def loader():
+            snapshot = load_snapshot(path)
+            if not snapshot:
+                raise IOError('Invalid ocdid snapshot: {}'.format(path))
+            return snapshot
+        return cls(loader)
+
+    def load(self):
+        """Loads the ocdid data if it hasn't been loaded yet"""
+        if self._data is None:
+            self._checksum, self._data = self._loader()
+        return self._data
+
+    def prepare(self):
+        """Loads the ocdid data and builds the alias table matching otherwise
+        builds on first use, so processes forked afterwards share it
+        rather than each building its own
+        """
+        self.load()
+        if self._aliases is None:
+            self._aliases = build_alias_index(self.store)
+
+    @property
+    def store(self):
+        return self.load()['store']
+
+    @property
+    def ocdid_set(self):
+        return self._view('ocdid_set', self.store.ocdid_set)
+
+    @property
+    def exceptions(self):
+        return self._view('exceptions', self.store.exception_dict)
+
+    @property
+    def ocdids(self):
+        return self._view('ocdids', self.store.ocdid_dict)
+
+    def _view(self, name, build):
+        """Returns a string based view of the store, building it once"""
+        if name not in self._views:
+            self._views[name] = build()
+        return self._views[name]
+
+    @property
+    def checksum(self):
+        if self._checksum is None:
+            if self._checksummer is None:
+                self.load()
+            else:
+                self._checksum = self._checksummer()
+        return self._checksum
+
+    @property
+    def match_checksum(self):
+        """See match_checksum, for keying match results of this index"""
+        return match_checksum(self.checksum)
+
+    @property
+    def changes(self):
+        """See diff_ocdid_data, the changes from the dataset the previous
+        snapshot was built from, None if unknown
+        """
+        return self.load().get('changes')
+
+    def is_ocdid(self, ocdid):
+        """Check whether given ocdid is contained in the official ocdid list
+
+        Keyword arguments:
+        ocdid -- ocdid value to check if exists in the official ocdid list
+
+        Returns:
+        True -- ocdid exists
+        False -- ocdid not found (could be candidate for new ocdid)
+
+        """
+        node = self.store.node(ocdid)
+        if node is not None and self.store.is_valid(node):
+            return True
+        else:
+            return False
+
+    def is_exception(self, ocdid):
+        """Check whether given ocdid is contained in the exception list
+
+        Keyword arguments:
+        ocdid -- ocdid value to check if exists in the exception list
+
+        Returns:
+        True -- ocdid exists
+        False -- ocdid not found (could be candidate for new ocdid)
+
+        """
+        if self.store.node(ocdid) in self.store.exceptions:
+            return True
+        else:
+            return False
+
+    def get_exception(self, ocdid):
+        """Returns official ocdid if ocdid value is in exceptions
+
+        Keyword arguments:
+        ocdid -- ocdid value to get official ocdid from exception list
+
+        Returns:
+        ocdid -- ocdid exception exists
+        None -- exception not found (could be candidate for new ocdid)
+
+        """
+        return self.store.exceptions.get(self.store.node(ocdid))
+
+    def match_name(self, ocdid_prefix, dist_type, dist_name):
+        """Given a district name, returns closest ocdid match in given district
+
+        Keyword arguments:
+        ocdid_prefix -- ocdid section up to type value, must exist in ocdids
+        dist_type -- district type value, must exist in ocdids[ocdid_prefix]
+        dist_name -- district name to attempt match
+
+        Returns:
+        ocdid,ratio -- if match found, returns valid ocdid and name match ratio
+        None,-1 -- if match not found, returns None for ocdid and -1 match ratio
+
+        """
+        return self.match_names(ocdid_prefix, dist_type, [dist_name])[0]
+
+    def match_names(self, ocdid_prefix, dist_type, dist_names):
+        """Given a group of district names of the same prefix and type, returns
+        the closest ocdid match for each one. The district list is looked up
+        once for the group, repeated names are matched once, and each name
+        only scores the district names whose length can still beat the best
+        score so far (see best_choices)
+
+        Keyword arguments:
+        ocdid_prefix -- ocdid section up to type value, must exist in ocdids
+        dist_type -- district type value, must exist in ocdids[ocdid_prefix]
+        dist_names -- list of district names to attempt match
+
+        Returns:
+        [(ocdid,ratio)] -- one match_name result per name, in the same order
+
+        """
+        return [candidates[0] if candidates else (None, -1)
+                for candidates in self.match_candidates(
+                    ocdid_prefix, dist_type, dist_names, 1)]
+
+    def match_candidates(self, ocdid_prefix, dist_type, dist_names, limit):
+        """match_names, keeping the next best matches found along the way as
+        candidates for review. They come from the same scoring pass, which
+        only prunes names that can't beat the last candidate kept. A name
+        resolved exactly or by number has no other candidates
+
+        Keyword arguments:
+        ocdid_prefix -- ocdid section up to type value, must exist in ocdids
+        dist_type -- district type value, must exist in ocdids[ocdid_prefix]
+        dist_names -- list of district names to attempt match
+        limit -- maximum number of candidates per name, the match included
+
+        Returns:
+        [[(ocdid,ratio)]] -- candidates for each name in the same order,
+                                 best first (the match_names result), empty
+                                 if there is no match
+
+        """
+        bucket = self.store.find_bucket(ocdid_prefix, dist_type)
+        if bucket is None:
+            # print 'Invalid ocdid_prefix or dist_type provided'
+            # print 'Prefix: {} Dist_type: {}'.format(ocdid_prefix, dist_type)
+            return [[] for dist_name in dist_names]
+        nodes = self.store.bucket_nodes[bucket]
+
+        matches = {}
+        results = []
+        for dist_name in dist_names:
+            query = normalize_name(dist_name)
+            if query not in matches:
+                candidates = []
+                for position, ratio in self.best_choices(bucket, query, limit):
+                    id_val, ratio = self._resolve_match(nodes[position], ratio)
+                    # exceptions can share their official ocdid
+                    if id_val not in [c[0] for c in candidates]:
+                        candidates.append((id_val, ratio))
+                matches[query] = candidates
+            results.append(matches[query])
+        return results
+
+    def best_choices(self, bucket, query, limit):
+        """Finds the best scoring district names of a bucket for a normalized
+        name, earlier names first on ties as in extractOne. With Match.PRUNE
+        the names are visited a length at a time, most promising length
+        first, and names whose score_bound can't beat the last one kept are
+        never scored
+
+        Keyword arguments:
+        bucket -- store bucket of the district names
+        query -- name run through normalize_name
+        limit -- maximum number of names returned
+
+        Returns:
+        [(position,ratio)] -- positions of the best names in the bucket and
+                                  their scores, best first
+
+        """
+        # an identical name is the only one scoring 100, and the first wins
+        best = self.store.exact_position(bucket, query) if query else None
+        if best is not None:
+            return [(best, 100)]
+        # numbered districts match by number only, 3 never matches 13
+        numbers = self.load()['numbers'].get(bucket)
+        if numbers:
+            number = district_number(query)
+            if number is not None:
+                best = numbers.get(number)
+                return [(best, 100)] if best is not None else []
+
+        choices = self.store.bucket_normalized[bucket]
+        strings = self.store.strings
+        if Match.PRUNE:
+            groups = sorted(((score_bound(len(query), length), positions)
+                             for length, positions in self.load()['lengths'][bucket]),
+                            key=itemgetter(0), reverse=True)
+        else:
+            groups = [(100, range(len(choices)))]
+
+        # heap of (ratio, -position) of the names kept, the last one on top
+        kept = []
+        for bound, positions in groups:
+            if len(kept) == limit and bound < kept[0][0]:
+                break
+            for position in positions:
+                # only an earlier name can tie the last one kept and replace it
+                if len(kept) == limit and bound == kept[0][0] and \
+                        position > -kept[0][1]:
+                    break
+                key = (score(query, strings[choices[position]]), -position)
+                if len(kept) < limit:
+                    heapq.heappush(kept, key)
+                elif key > kept[0]:
+                    heapq.heapreplace(kept, key)
+        return [(-position, ratio)
+                for ratio, position in sorted(kept, reverse=True)]
+
+    def _resolve_match(self, node, ratio):
+        """Formats a matched node as an ocdid, check that it exists, return id
+        value and match ratio, swapping exceptions for their official ocdid
+        """
+        if node in self.store.exceptions:
+            return self.store.exceptions[node], ratio
+        elif self.store.is_valid(node):
+            return self.store.ocdid(node), ratio
+        else:
+            return None, -1
+
+    def match_type(self, ocdid_prefix, dist_type, dist_count, **kwargs):
+        """Given a district type and count, returns official ocdid district type
+
+        Keyword arguments:
+        ocdid_prefix -- ocdid section up to type value, must exist in ocdids
+        dist_type -- district type value, suggested types are: park, ward,
+                         school, education, commission, council, district
+                         (generic)
+        dist_count -- count of districts of given type in specific geography
+        kwargs['districts'] -- the actual district names from the flat file,
+                                   optional
+        Returns:
+        key -- if match found, returns valid ocdid and name match ratio
+        'No match' -- if not match found, returns None for ocdid and -1 match
+                          ratio
+
+        """
+        # default initial values for key, district length difference, and
+        key = ''
+        diff_len = 1000
+        type_ratio = 0
+        key_order = -1
+
+        parent = self.store.node(ocdid_prefix)
+        if parent not in self.load()['type_index']:
+            return None
+        counts, signatures = self.load()['type_index'][parent]
+
+        # matches to district closest in count, found by walking out from
+        # dist_count in the types sorted by count. School and precinct based
+        # districts are skipped unless explicitly requested
+        pos = bisect.bisect_left(counts, (dist_count,))
+        for i in range(pos - 1, -1, -1):
+            if is_candidate_type(counts[i][2], dist_type):
+                diff_len = min(diff_len, dist_count - counts[i][0])
+                break
+        for i in range(pos, len(counts)):
+            if is_candidate_type(counts[i][2], dist_type):
+                diff_len = min(diff_len, counts[i][0] - dist_count)
+                break
+
+        # using district type as a secondary matching trait among the closest
+        # counts, in ocdids order, 'district' is the generic type
+        if diff_len < 1000:
+            closest = []
+            for count in set([dist_count - diff_len, dist_count + diff_len]):
+                start = bisect.bisect_left(counts, (count,))
+                end = bisect.bisect_left(counts, (count + 1,))
+                closest.extend(counts[start:end])
+            for count, order, k in sorted(closest, key=itemgetter(1)):
+                if not is_candidate_type(k, dist_type):
+                    continue
+                new_type_ratio = cached_type_ratio(k, dist_type)
+                if not key:
+                    key = k
+                    type_ratio = new_type_ratio
+                    key_order = order
+                elif dist_type != 'district' and new_type_ratio > type_ratio:
+                    key = k
+                    type_ratio = new_type_ratio
+                    key_order = order
+
+        # a type whose district names are exactly the given names wins, unless
+        # a closer type comes after it in ocdids order. Looked up by the
+        # order independent signature of the names
+        districts = kwargs.get('districts')
+        if districts:
+            for order, k in signatures.get(name_signature(districts), []):
+                if order >= key_order and is_candidate_type(k, dist_type) and \
+                        set(districts) == set(self.store.names(
+                            self.store.bucket(parent, k))):
+                    key = k
+
+        # district length difference must be less than 5% for a valid match
+        if float(diff_len)/dist_count < .05:
+            return key
+        else:
+            return None
+
+    def ancestors(self, segments):
+        """Walks the ocdid tree down a list of district values, resolving
+        every ancestor of the full ocdid in one pass
+
+        Keyword arguments:
+        segments -- list of district values below the country ocdid
+                        (ex. ['state:ca', 'county:marin'])
+
+        Returns:
+        path -- the ocdid at each depth walked, None where that prefix is not
+                    a valid ocdid itself. The walk stops at the first value
+                    not found, so path may be shorter than segments
+
+        """
+        node = self.store.node(Ocdid.COUNTRY)
+        ocdid = Ocdid.COUNTRY
+        path = []
+        for segment in segments:
+            if node is not None:
+                node = self.store.child(node, segment)
+            if node is None:
+                break
+            ocdid = '{}/{}'.format(ocdid, segment)
+            path.append(ocdid if self.store.is_valid(node) else None)
+        return path
+
+    def match_child(self, ocdid_prefix, segment):
+        """Matches a district value to the children of an ocdid
+
+        Keyword arguments:
+        ocdid_prefix -- parent ocdid, None if there is no valid parent
+        segment -- district value to match (ex. 'county:marin')
+
+        Returns:
+        ocdid, ratio -- see match_name, None and -1 if there is no parent
+
+        """
+        if ocdid_prefix is None:
+            return None, -1
+        dist_type, dist_name = segment.split(':')
+        return self.match_name(ocdid_prefix, dist_type, dist_name)
+
+    def suggest(self, ocdid, limit=Match.SUGGEST_LIMIT,
+                max_distance=Match.SUGGEST_DISTANCE):
+        """Finds the current ocdids closest to one that doesn't exist, to
+        catch typos. The ocdid is walked as far as it exists, and from the
+        first segment that doesn't, each segment is matched through a
+        BK-tree of the child segments of the node above it, with the edits
+        spread over any of those segments (edits to the '/' separators
+        aren't found). A node's BK-tree is built the first time it is
+        searched
+
+        Keyword arguments:
+        ocdid -- ocdid value to find suggestions for
+        limit -- maximum number of suggestions
+        max_distance -- maximum total edits between ocdid and a suggestion
+
+        Returns:
+        [(distance,ocdid)] -- closest first, empty if ocdid exists
+
+        """
+        if self.is_ocdid(ocdid):
+            return []
+        segments = ocdid.split('/')
+
+        parent = -1
+        depth = 0
+        while depth < len(segments):
+            node = self._child_of(parent, segments[depth])
+            if node is None:
+                break
+            parent = node
+            depth += 1
+        # the whole ocdid is only a prefix, try its siblings
+        if depth == len(segments):
+            depth -= 1
+            parent = self.store.node_parent[parent]
+
+        suggestions = []
+        self._suggest_below(parent, segments[depth:], 0, max_distance,
+                            suggestions)
+        return sorted(suggestions)[:limit]
+
+    def _suggest_below(self, parent, segments, distance, max_distance,
+                       suggestions):
+        """Adds the current ocdids below parent that are within max_distance
+        edits of its ocdid plus segments to suggestions
+        """
+        tree = self._segment_tree(parent)
+        for edits, segment in tree.search(segments[0], max_distance - distance):
+            node = self._child_of(parent, segment)
+            if len(segments) > 1:
+                self._suggest_below(node, segments[1:], distance + edits,
+                                    max_distance, suggestions)
+            elif self.store.is_valid(node):
+                suggestions.append((distance + edits, self.store.ocdid(node)))
+
+    def _child_of(self, parent, segment):
+        """store.child, treating the roots as children of -1"""
+        if parent == -1:
+            return self.store.roots.get(segment)
+        return self.store.child(parent, segment)
+
+    def _segment_tree(self, parent):
+        """BK-tree of the child segments of a node, built once"""
+        if parent not in self._segment_trees:
+            if self._children is None:
+                self._children = self.store.children_by_parent()
+            self._segment_trees[parent] = BKTree(
+                self.store.segment(node)
+                for node in self._children.get(parent, ()))
+        return self._segment_trees[parent]
+
+    def alias(self, prefix_list):
+        """Looks a district list up in the alias table of its state (see
+        build_alias_index), which is built the first time it is used
+
+        Keyword arguments:
+        prefix_list -- list of district values for the ocdid
+
+        Returns:
+        ocdid -- ocdid the last district value stands for in its state
+        None -- no alias, or more than one ocdid shares it
+
+        """
+        if len(prefix_list) < 2:
+            return None
+        if self._aliases is None:
+            self._aliases = build_alias_index(self.store)
+        dist_type, sep, name = prefix_list[-1].partition(':')
+        node = self._aliases.get((prefix_list[0], dist_type,
+                                  normalize_name(name)))
+        if node is None:
+            return None
+        return self.store.ocdid(node)
+
+    def get_full_prefix(self, prefix_list):
+        """When provided a district list, searches a returns to closest ocdid
+        match for that district and the text match ratio
+
+        Keyword arguments:
+        prefix_list -- list of district values for the ocdid, not modified
+
+        Returns:
+        id_val -- full valid ocdid value
+        ratio -- match ratio of district name provided to ocdid name
+
+        """
+        # If the list is empty, it's just the country ocdid
+        if len(prefix_list) == 0:
+            return Ocdid.COUNTRY, 100
+        prefix_list = list(prefix_list)
+
+        # Check if there is an immediate exact match. If so, return with a
+        # ratio of 100. The same walk gives the parents checked below
+        depth = len(prefix_list)
+        path = self.ancestors(prefix_list)
+        id_val = path_ocdid(path, depth)
+        if id_val:
+            return id_val, 100
+
+        # Then for a name that only differs in form, or is an alias, from
+        # one district of its type in the state
+        id_val = self.alias(prefix_list)
+        if id_val:
+            return id_val, 100
+
+        # NY City/Villages have exceptions since there can be cities,
+        # villages, and towns with the same name in the same county
+        dist_type, sep, name = prefix_list[-1].partition(':')
+        for name_prefix in Match.NAME_PREFIXES.get(dist_type, ()):
+            name_prefix = name_prefix.replace(' ', '_') + '_'
+            if depth > 1 and name.startswith(name_prefix):
+                prefix_list.pop(-2)
+                prefix_list[-1] = '{}:{}'.format(dist_type,
+                                                 name[len(name_prefix):])
+                depth -= 1
+                path = self.ancestors(prefix_list)
+                id_val = path_ocdid(path, depth)
+                if id_val:
+                    return id_val, 100
+                break
+
+        # Check for a closely similar match if no exact match exists
+        if depth > 1:
+            id_val, ratio = self.match_child(path_ocdid(path, depth - 1),
+                                             prefix_list[-1])
+            if ratio >= 91:
+                return id_val, ratio
+
+        # Try removing district values from list to find a match. For
+        # example, a city district might be state->city element instead of
+        # state->county->city
+        if depth > 2:
+            id_val, ratio = self.match_child(path_ocdid(path, depth - 2),
+                                             prefix_list[-2])
+            if ratio <= 91:
+                return None, -1
+            prefix_list[-2] = id_val.split('/')[-1]
+
+            path = self.ancestors(prefix_list)
+            id_val = path_ocdid(path, depth)
+            if id_val:
+                return id_val, 100
+
+            id_val, ratio = self.match_child(path_ocdid(path, depth - 1),
+                                             prefix_list[-1])
+            if ratio >= 91:
+                return id_val, ratio
+            else:
+                prefix_list.pop(-2)
+                depth -= 1
+                path = self.ancestors(prefix_list)
+                id_val = path_ocdid(path, depth)
+                if id_val:
+                    return id_val, 100
+                id_val, ratio = self.match_child(path_ocdid(path, depth - 1),
+                                                 prefix_list[-1])
+                if ratio >= 91:
+                    return id_val, ratio
+        # Return None and -1 for the ratio if no match is found
+        return id_val, -1
+
+    def name_search(self, name):
+        """Given a district name, searches for all matching ocdids
+
+        searches everything through the n-gram index, type_name_search is
+        more limiting if the district type is known
+
+        Keyword arguments:
+        name -- district name to search for
+
+        Returns:
+        match_list[:MATCH_LIMIT] -- a list of the top 'MATCH_LIMIT' matches
+                                        that at least meet 'MATCH_RATIO'
+
+        """
+        return self._search(name)
+
+    def type_name_search(self, type_val, name):
+        """Given a district name and type, searches for all matching ocdids
+
+        Keyword arguments:
+        type_val -- district type to search for, valid types: anc, cd, county,
+                        council, village, borough, ward, township, city,
+                        court, parish, state, territory, sldu, commissioner,
+                        sldl, precinct, town, school, country, region,
+                        census_area. An ocdid district type (council_district,
+                        etc.) searches only that type, anything else searches
+                        every type
+        name -- district name to search for
+
+        Returns:
+        match_list[:MATCH_LIMIT] -- a list of the top 'MATCH_LIMIT' matches
+                                        that at least meet 'MATCH_RATIO'
+
+        """
+        return self._search(name, self.valid_dists(type_val))
+
+    def valid_dists(self, type_val):
+        """Returns the set of ocdid district types type_name_search searches
+        for a type, None for all
+        """
+        # if type_val is standard, use the set of valid district type matches,
+        # if it is an ocdid district type search just that type, otherwise
+        # accept 'all' matches
+        if type_val in Match.CONVERSIONS:
+            return Match.CONVERSIONS[type_val]
+        elif type_val in self.load()['grams']['postings']:
+            return set([type_val])
+        return None
+
+    def _search(self, name, valid_dists=None):
+        """Finds the closest name in each set of districts, keeping the top
+        'MATCH_LIMIT' that are > MATCH_RATIO, see search_heap
+
+        Keyword arguments:
+        name -- district name to search for
+        valid_dists -- set of district types to search, None for all
+
+        Returns:
+        match_list -- list of (ratio, ocdid), best first
+
+        """
+        return search_results(self.search_heap(name, valid_dists))
+
+    def search_heap(self, name, valid_dists=None):
+        """The search behind name_search and type_name_search. Only names
+        sharing enough n-grams with the search name (Match.NGRAM_OVERLAP)
+        are scored. The share isn't derived from the score, WRatio's partial
+        and token scorers don't bound how many n-grams a name > MATCH_RATIO
+        shares, so the search is approximate and can miss such a name.
+        The index is partitioned by district type, so a type restricted
+        search only reads the postings of those types
+
+        Keyword arguments:
+        name -- district name to search for
+        valid_dists -- set of district types to search, None for all
+
+        Returns:
+        match_heap -- heap of the top 'MATCH_LIMIT' (ratio, bucket, ocdid)
+                          that are > MATCH_RATIO, one per bucket. Heaps of
+                          disjoint sets of buckets (see shard) merge with
+                          merge_search_heaps
+
+        """
+        grams = self.load()['grams']
+        store = self.store
+        query = normalize_name(name)
+        query_grams = ngrams(query)
+
+        if valid_dists is None:
+            postings = list(grams['postings'].values())
+        else:
+            postings = [grams['postings'][dist_type] for dist_type in valid_dists
+                        if dist_type in grams['postings']]
+
+        # count the n-grams each name shares with the search name
+        shared = {}
+        for type_postings in postings:
+            for gram in query_grams:
+                for entry in type_postings.get(gram, ()):
+                    shared[entry] = shared.get(entry, 0) + 1
+        min_shared = max(1, int(math.ceil(len(query_grams) * Match.NGRAM_OVERLAP)))
+
+        # names too long or short to score > MATCH_RATIO are dropped here
+        if Match.PRUNE:
+            shortest, longest = length_range(len(query), Match.RATIO + 1)
+        else:
+            shortest, longest = 0, float('inf')
+        candidates = {}
+        for entry, count in shared.items():
+            if count >= min_shared and \
+                    shortest <= grams['entry_length'][entry] <= longest:
+                bucket = grams['entry_bucket'][entry]
+                candidates.setdefault(bucket, []).append(grams['entry_position'][entry])
+
+        # pull the closest candidate from each set of districts, keeping the
+        # top MATCH_LIMIT that are > MATCH_RATIO in a bounded heap. Buckets
+        # are visited in order, so once the heap is full a bucket needs at
+        # least the heap's lowest ratio to get in
+        match_heap = []
+        for bucket in sorted(candidates):
+            choices = store.bucket_normalized[bucket]
+            floor = Match.RATIO + 1
+            if len(match_heap) == Match.LIMIT:
+                floor = max(floor, match_heap[0][0])
+            best, ratio = None, -1
+            for position in sorted(candidates[bucket]):
+                name = store.strings[choices[position]]
+                if Match.PRUNE:
+                    bound = score_bound(len(query), len(name))
+                    if bound < floor or bound <= ratio:
+                        continue
+                new_ratio = score(query, name)
+                if new_ratio > ratio:
+                    best, ratio = position, new_ratio
+            # buckets are unique, so the node never decides the order
+            if ratio > Match.RATIO:
+                node = store.bucket_nodes[bucket][best]
+                if len(match_heap) < Match.LIMIT:
+                    heapq.heappush(match_heap, (ratio, bucket, node))
+                else:
+                    heapq.heappushpop(match_heap, (ratio, bucket, node))
+
+        return [(ratio, bucket, store.ocdid(node))
+                for ratio, bucket, node in match_heap]
+
+    def shard(self, number, count):
+        """Index over the same data whose name searches only cover every
+        count-th bucket, starting at number, for splitting a search across
+        processes (see search_pool.SearchPool). The shard's n-gram postings
+        are filtered from this index's the first time it is used
+
+        Keyword arguments:
+        number -- shard number, from 0 to count - 1
+        count -- number of shards
+
+        Returns:
+        index -- OcdidIndex
+
+        """
+        def loader():
+            data = dict(self.load())
+            grams = dict(data['grams'])
+            entry_bucket = grams['entry_bucket']
+            grams['postings'] = dict(
+                (dist_type, dict(
+                    (gram, array('i', (entry for entry in entries
+                                       if entry_bucket[entry] % count == number)))
+                    for gram, entries in type_postings.items()))
+                for dist_type, type_postings in grams['postings'].items())
+            data['grams'] = grams
+            return self.checksum, data
+        return OcdidIndex(loader)
+
+    def print_subdistrict_data(self, ocdid_prefix):
+        """Given a district name, returns closest ocdid match in given district
+
+        Keyword arguments:
+        ocdid_prefix -- district name to attempt match
+
+        """
+        for bucket in self.store.parent_buckets[self.store.node(ocdid_prefix)]:
+            print('  - {}:{}'.format(self.store.dist_type(bucket),
+                                     self.store.names(bucket)))
+
+
+def use_service(address=Ocdid.SERVICE):
+    """Sends the module level matching functions to a running ocdid_service
+    rather than the default index. A service matching against other ocdid
+    data than the default index (see match_checksum) isn't used, and should
+    the service go away, they go back to the default index
 
     Keyword arguments:
-    ocdid -- ocdid value to check if exists in the official ocdid list
+    address -- Unix socket of the service
 
     Returns:
-    True -- ocdid exists
-    False -- ocdid not found (could be candidate for new ocdid)
+    True -- if the service was reached and matches the default index
 
     """
-    if ocdid in ocdid_set:
-        return True
-    else:
+    global service
+    from ocdid_service import OcdidClient, ServiceError
+    try:
+        service = OcdidClient(address, index)
+    except OSError:
         return False
+    except ServiceError as e:
+        print('Not using the ocdid service: {}'.format(e))
+        return False
+    return True
+
+
+def matcher():
+    """The service when use_service reached one, otherwise the default index"""
+    return service or index
+
+
+def is_ocdid(ocdid):
+    """See OcdidIndex.is_ocdid, uses the default index or service"""
+    return matcher().is_ocdid(ocdid)
 
 
 def is_exception(ocdid):
-    """Check whether given ocdid is contained in the exception list
+    """See OcdidIndex.is_exception, uses the default index or service"""
+    return matcher().is_exception(ocdid)
+
+
+def get_exception(ocdid):
+    """See OcdidIndex.get_exception, uses the default index or service"""
+    return matcher().get_exception(ocdid)
+
+
+def match_child(ocdid_prefix, segment):
+    """See OcdidIndex.match_child, uses the default index or service"""
+    return matcher().match_child(ocdid_prefix, segment)
+
+
+def match_name(ocdid_prefix, dist_type, dist_name):
+    """See OcdidIndex.match_name, uses the default index or service"""
+    return matcher().match_name(ocdid_prefix, dist_type, dist_name)
+
+
+def match_names(ocdid_prefix, dist_type, dist_names):
+    """See OcdidIndex.match_names, uses the default index or service"""
+    return matcher().match_names(ocdid_prefix, dist_type, dist_names)
+
+
+def match_candidates(ocdid_prefix, dist_type, dist_names, limit):
+    """See OcdidIndex.match_candidates, uses the default index or service"""
+    return matcher().match_candidates(ocdid_prefix, dist_type, dist_names, limit)
+
+
+def match_type(ocdid_prefix, dist_type, dist_count, **kwargs):
+    """See OcdidIndex.match_type, uses the default index or service"""
+    return matcher().match_type(ocdid_prefix, dist_type, dist_count, **kwargs)
+
+
+def ancestors(segments):
+    """See OcdidIndex.ancestors, uses the default index or service"""
+    return matcher().ancestors(segments)
+
+
+def suggest(ocdid, limit=Match.SUGGEST_LIMIT,
+            max_distance=Match.SUGGEST_DISTANCE):
+    """See OcdidIndex.suggest, uses the default index or service"""
+    return matcher().suggest(ocdid, limit, max_distance)
+
+
+def get_full_prefix(prefix_list):
+    """See OcdidIndex.get_full_prefix, uses the default index or service"""
+    return matcher().get_full_prefix(prefix_list)
+
+
+def name_search(name):
+    """See OcdidIndex.name_search, uses the default index or service"""
+    return matcher().name_search(name)
+
+
+def type_name_search(type_val, name):
+    """See OcdidIndex.type_name_search, uses the default index or service"""
+    return matcher().type_name_search(type_val, name)
+
+
+def print_subdistrict_data(ocdid_prefix):
+    """See OcdidIndex.print_subdistrict_data, uses the default index"""
+    index.print_subdistrict_data(ocdid_prefix)
+
+
+def __getattr__(name):
+    """Module level ocdid_set, exceptions and ocdids come from the default
+    index, loading it on first access
+    """
+    if name in ('ocdid_set', 'exceptions', 'ocdids'):
+        return getattr(index, name)
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+
+def dataset_checksum(data):
+    """Returns the checksum identifying a version of the ocdid dataset. The
+    config the snapshot data is built with is included, the non-current
+    district list, the n-gram length of the search index and the numbered
+    district types, so that editing any of them invalidates a snapshot
+    built with the old values
 
     Keyword arguments:
-    ocdid -- ocdid value to check if exists in the exception list
+    data -- raw bytes of the ocdid csv file
 
     Returns:
-    True -- ocdid exists
-    False -- ocdid not found (could be candidate for new ocdid)
+    checksum -- hex digest of the csv data, that config and format version
 
     """
-    if ocdid in exceptions:
-        return True
-    else:
-        return False
+    checksum = hashlib.sha1(data)
+    for ocdid in sorted(Ocdid.NONCURRENT_DIST):
+        checksum.update(ocdid.encode('utf-8'))
+    checksum.update(config_checksum().encode('utf-8'))
+    checksum.update(str(Ocdid.SNAPSHOT_VERSION).encode('utf-8'))
+    return checksum.hexdigest()
 
 
-def get_exception(ocdid):
-    """Returns official ocdid if ocdid value is in exceptions
+def config_checksum():
+    """Returns a checksum of the match config the structures built from the
+    ocdid data depend on: Match.NGRAM for the n-gram postings and
+    Match.NUMBERED_TYPES for the number index
+    """
+    checksum = hashlib.sha1('ngram:{}\n'.format(Match.NGRAM).encode('utf-8'))
+    checksum.update('numbered:{}\n'.format(
+        ','.join(sorted(Match.NUMBERED_TYPES))).encode('utf-8'))
+    return checksum.hexdigest()
+
+
+def match_checksum(checksum, aliases=Ocdid.ALIASES):
+    """Returns the checksum identifying the match results of a dataset.
+    Besides the dataset, get_full_prefix results depend on the curated alias
+    table and Match.NAME_PREFIXES, which aren't part of the dataset checksum
 
     Keyword arguments:
-    ocdid -- ocdid value to get official ocdid from exception list
+    checksum -- dataset checksum, see dataset_checksum
+    aliases -- curated alias csv file, missing if there is none
 
     Returns:
-    ocdid -- ocdid exception exists
-    None -- exception not found (could be candidate for new ocdid)
+    checksum -- hex digest of the dataset checksum, aliases and prefixes
 
     """
-    if ocdid in exceptions:
-        return exceptions[ocdid]
+    digest = hashlib.sha1(checksum.encode('utf-8'))
+    try:
+        with open(aliases, 'rb') as f:
+            digest.update(f.read())
+    except IOError:
+        pass
+    for dist_type, name_prefixes in sorted(Match.NAME_PREFIXES.items()):
+        digest.update('{}:{}\n'.format(dist_type, ','.join(name_prefixes))
+                      .encode('utf-8'))
+    return digest.hexdigest()
+
+
+def parse_ocdid_data(data):
+    """Parses raw ocdid csv data into the structures used for matching
+
+    Keyword arguments:
+    data -- raw bytes of the ocdid csv file
+
+    Returns:
+    see build_ocdid_data
+
+    """
+    reader = DictReader(io.StringIO(data.decode('utf-8')))
+    return build_ocdid_data((row['id'], row['sameAs']) for row in reader)
+
+
+def build_ocdid_data(rows):
+    """Builds the structures used for matching from ocdid rows
+
+    Keyword arguments:
+    rows -- iterable of (ocdid, sameAs) pairs, sameAs empty if not an
+                exception
+
+    Returns:
+    data -- dict of
+                store -- OcdidStore of the current ocdids and exceptions,
+                             names normalized with normalize_name for scoring
+                grams -- n-gram index of the names, see build_gram_index
+                lengths -- length groups of the names, see
+                               build_length_index
+                numbers -- numbered district names, see
+                               build_number_index
+                type_index -- district type counts and signatures, see
+                                  build_type_index
+                config -- match config it was built with, see
+                              config_checksum
+
+    """
+    # Generate a set of only ocdid data with empty values removed
+    ocdid_set = set()
+    exceptions = {}
+    for id_val, same_as in rows:
+        if id_val not in Ocdid.NONCURRENT_DIST:
+            ocdid_set.add(id_val)
+            if same_as:
+                exceptions[id_val] = same_as
+
+    store = OcdidStore.build(ocdid_set, exceptions, normalize_name)
+    return {'store': store,
+            'grams': build_gram_index(store),
+            'lengths': build_length_index(store),
+            'numbers': build_number_index(store),
+            'type_index': build_type_index(store),
+            'config': config_checksum()}
+
+
+def merge_search_heaps(heaps):
+    """Merges search_heap results over disjoint sets of buckets into the
+    heap a single search over all of them would give
+    """
+    return heapq.nlargest(Match.LIMIT, (match for match_heap in heaps
+                                        for match in match_heap))
+
+
+def search_results(match_heap):
+    """Formats a search_heap as a match list of (ratio, ocdid), highest ratio
+    first, later districts first among equal ratios
+    """
+    return [(ratio, ocdid) for ratio, bucket, ocdid in
+            sorted(match_heap, reverse=True)]
+
+
+def path_ocdid(path, depth):
+    """Returns the ocdid at a depth (1 is the first district value) of a path
+    from OcdidIndex.ancestors, None if the walk stopped short of it or that
+    prefix is not a valid ocdid
+    """
+    if 0 < depth <= len(path):
+        return path[depth - 1]
     return None
 
 
-def match_name(ocdid_prefix, dist_type, dist_name):
-    """Given a district name, returns closest ocdid match in given district
+def is_candidate_type(ocdid_type, dist_type):
+    """School and precinct based ocdid types only match when explicitly
+    requested by match_type's dist_type
+    """
+    if 'school' in ocdid_type and dist_type != 'school':
+        return False
+    if 'precinct' in ocdid_type and dist_type != 'precinct':
+        return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def cached_type_ratio(ocdid_type, dist_type):
+    """fuzz.ratio of an ocdid type and a requested type, there are only a
+    few dozen of each so every pair is scored once per process
+    """
+    return fuzz.ratio(ocdid_type, dist_type)
+
+
+def name_signature(names):
+    """Order independent signature of a set of district names, the count and
+    the xor of each name's crc32. Stable across processes, unlike hash()
+    """
+    names = set(names)
+    signature = 0
+    for name in names:
+        signature ^= zlib.crc32(name.encode('utf-8'))
+    return len(names), signature
+
+
+def build_type_index(store):
+    """Builds the per prefix lookups used by match_type
 
     Keyword arguments:
-    ocdid_prefix -- ocdid section up to type value, must exist in ocdids
-    dist_type -- district type value, must exist in ocdids[ocdid_prefix]
-    dist_name -- district name to attempt match
+    store -- OcdidStore of the current ocdids
 
     Returns:
-    ocdid,ratio -- if match found, returns valid ocdid and name match ratio
-    None,-1 -- if match not found, returns None for ocdid and -1 match ratio
+    type_index -- dict of prefix node -> (counts, signatures), where counts
+                      is a sorted list of (name count, dataset order, type)
+                      and signatures is a dict of name_signature ->
+                      [(dataset order, type)]
 
     """
-    if dist_name == 'dona_ana':
-        return 'ocd-division/country:us/state:nm/county:dona_ana', 100
+    type_index = {}
+    for parent, buckets in store.parent_buckets.items():
+        counts = []
+        signatures = {}
+        for order, bucket in enumerate(buckets):
+            dist_type = store.dist_type(bucket)
+            dist_names = store.names(bucket)
+            counts.append((len(dist_names), order, dist_type))
+            signatures.setdefault(name_signature(dist_names),
+                                  []).append((order, dist_type))
+        counts.sort()
+        type_index[parent] = counts, signatures
+    return type_index
 
-    # from list of districts of a given type, find the closest match
-    try:
-        match = process.extractOne(dist_name, ocdids[ocdid_prefix][dist_type])
-    except KeyError:
-        # print 'Invalid ocdid_prefix or dist_type provided'
-        # print 'Prefix: {} Dist_type: {}'.format(ocdid_prefix, dist_type)
-        return None, -1
 
-    # if match fails, return empty values
-    if not match:
-        return None, -1
-    id_val, ratio = match
+def normalize_name(name):
+    """Normalizes a district name for scoring. On top of fuzzywuzzy's
+    processing (lower case, letters and numbers only) underscores separate
+    words, accents are dropped rather than the whole letter ('doña_ana' ->
+    'dona ana') and 'saint' is shortened to 'st'
 
-    # format ocdid, check that it exists, return id value and match ratio
-    ocdid = '{}/{}:{}'.format(ocdid_prefix, dist_type, id_val)
+    Keyword arguments:
+    name -- district name, from an ocdid or a search
 
-    if is_exception(ocdid):
-        return get_exception(ocdid), ratio
-    elif is_ocdid(ocdid):
-        return ocdid, ratio
-    else:
-        return None, -1
+    Returns:
+    name -- normalized name, words separated by single spaces
 
+    """
+    name = unicodedata.normalize('NFKD', name.replace('_', ' '))
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    words = full_process(name, force_ascii=True).split()
+    return ' '.join('st' if word == 'saint' else word for word in words)
 
-def match_type(ocdid_prefix, dist_type, dist_count, **kwargs):
-    """Given a district type and count, returns official ocdid district type
+
+def build_alias_index(store, path=Ocdid.ALIASES):
+    """Builds the alias table get_full_prefix resolves names through before
+    any scoring. Every current ocdid below a state (or territory) is keyed
+    by the state's district value, its district type and its normalized
+    name, so variants normalize_name absorbs ('saint' and 'st', accents,
+    case) resolve directly. Names directly below the state are also keyed
+    with each of Match.NAME_PREFIXES for their type ('city of albany').
+    Keys shared by different ocdids in a state are left out, so an alias
+    is never a guess. Aliases in the curated csv override the generated ones
 
     Keyword arguments:
-    ocdid_prefix -- ocdid section up to type value, must exist in ocdids
-    dist_type -- district type value, suggested types are: park, ward, school,
-                     education, commission, council, district (generic)
-    dist_count -- count of districts of given type in specific geography
-    kwargs['districts'] -- the actual district names from the flat file
+    store -- OcdidStore to build the table for
+    path -- curated csv with 'alias' and 'ocdid' columns, the alias written
+                as an ocdid ('ocd-division/country:us/state:nh/county:coos'),
+                skipped if the file doesn't exist
+
     Returns:
-    key -- if match found, returns valid ocdid and name match ratio
-    'No match' -- if not match found, returns None for ocdid and -1 match ratio
+    aliases -- dict of (state district value, district type,
+                   normalized name) -> node
 
     """
-    # default initial values for key, district length difference, and
-    key = ''
-    diff_len = 1000
-    type_ratio = 0
+    country = store.node(Ocdid.COUNTRY)
+    aliases = {}
+    ambiguous = set()
 
-    if ocdid_prefix not in ocdids:
-        return None
+    def add(key, node):
+        if aliases.setdefault(key, node) != node:
+            ambiguous.add(key)
 
-    
-    for k, v in ocdids[ocdid_prefix].items():
-        # special case for school based districts, must be explicitly requested
-        if 'school' in k and dist_type != 'school':
+    regions = {}
+    for bucket, parent in enumerate(store.bucket_parent):
+        if parent == country or not store.bucket_nodes[bucket]:
             continue
-        if 'precinct' in k and dist_type != 'precinct':
+        region = parent
+        while region != -1 and store.node_parent[region] != country:
+            region = store.node_parent[region]
+        if region == -1:
             continue
-        # matches to district closest in count, using district type as a
-        # secondary matching trait, 'district' is the generic type
-        new_diff_len = abs(len(v)-dist_count)
-        new_type_ratio = fuzz.ratio(k, dist_type)
-        if new_diff_len < diff_len:
-            diff_len = new_diff_len
-            key = k
-            type_ratio = new_type_ratio
-        elif new_diff_len == diff_len and dist_type != 'district' and new_type_ratio > type_ratio:
-            key = k
-            type_ratio = new_type_ratio
-
-        if kwargs['districts'] == v:
-            key = k
-
-    # district length difference must be less than 5% for a valid match
-    if float(diff_len)/dist_count < .05:
-        return key
-    else:
-        return None
+        if region not in regions:
+            regions[region] = store.segment(region)
+        dist_type = store.dist_type(bucket)
+        prefixes = Match.NAME_PREFIXES.get(dist_type, ()) \
+            if parent == region else ()
+        for node, string_id in zip(store.bucket_nodes[bucket],
+                                   store.bucket_normalized[bucket]):
+            name = store.strings[string_id]
+            add((regions[region], dist_type, name), node)
+            for name_prefix in prefixes:
+                add((regions[region], dist_type,
+                     '{} {}'.format(name_prefix, name)), node)
+    for key in ambiguous:
+        del aliases[key]
 
+    if path and os.path.exists(path):
+        base = Ocdid.COUNTRY + '/'
+        with open(path, 'r') as f:
+            for row in DictReader(f):
+                node = store.node(row['ocdid'])
+                segments = row['alias'][len(base):].split('/')
+                if node is None or not store.is_valid(node) or \
+                        not row['alias'].startswith(base) or len(segments) < 2:
+                    raise ValueError('Invalid ocdid alias: {}, {}'.format(
+                        row['alias'], row['ocdid']))
+                dist_type, sep, name = segments[-1].partition(':')
+                aliases[(segments[0], dist_type, normalize_name(name))] = node
+    return aliases
 
-def name_search(name):
-    """Given a district name, searches for all matching ocdids
 
-    ***SLOW MATCHING***
-    searches everything, use a more limiting search for quicker results
+def score_bound(query_len, choice_len):
+    """Highest score `score` (WRatio) can give two names of these lengths.
+    Past a 1.5 length ratio only the partial scorers, scaled by .9, can
+    score higher than ratio, and past 8 they are scaled by .6. Below 1.5 the
+    token scorers are scaled by .95, leaving ratio, which can't exceed the
+    share of characters the shorter name could match
 
     Keyword arguments:
-    name -- district name to search for
+    query_len -- length of the normalized search name
+    choice_len -- length of the normalized district name
 
     Returns:
-    match_list[:MATCH_LIMIT] -- a list of the top 'MATCH_LIMIT' matches that
-                                    that at least meet 'MATCH_RATIO'
+    bound -- no pair of names with these lengths scores higher
 
     """
-    match_list = []
+    short, long = sorted((query_len, choice_len))
+    if short == 0:
+        return 0
+    if long > 8 * short:
+        return 60
+    if 2 * long >= 3 * short:
+        return 90
+    return max(95, int(math.ceil(200.0 * short / (short + long))))
 
-    for prefix, district in ocdids.items():
-        for dist_type, dist_names in district.items():
-            # pull the closest match from each set of districts, adds to
-            # match_list if > MATCH_RATIO
-            match_vals = process.extractOne(name, dist_names)
-            if match_vals and match_vals[1] > Match.RATIO:
-                match_list.append((match_vals[1], '{}/{}:{}'.format(prefix, dist_type, match_vals[0])))
 
-    # sorts and returns top MATCH_LIMIT matches
-    match_list = sorted(match_list, key=itemgetter(0))
-    match_list.reverse()
-    return match_list[:Match.LIMIT]
+def length_range(query_len, floor):
+    """Returns the (shortest, longest) name lengths whose score_bound with a
+    search name of query_len reaches floor, the bound only falls as lengths
+    move away from query_len
+    """
+    if score_bound(query_len, query_len) < floor:
+        return 1, 0
+    shortest = query_len
+    while shortest > 1 and score_bound(query_len, shortest - 1) >= floor:
+        shortest -= 1
+    # past 8 times the length the bound doesn't fall any further
+    if score_bound(query_len, 8 * query_len + 1) >= floor:
+        return shortest, float('inf')
+    longest = query_len
+    while score_bound(query_len, longest + 1) >= floor:
+        longest += 1
+    return shortest, longest
 
 
-def type_name_search(type_val, name):
-    """Given a district name and type, searches for all matching ocdids
+def ngrams(name, n=Match.NGRAM):
+    """Returns the set of n-grams of a processed name, padded with a space on
+    each side so short names and word boundaries still produce n-grams
+    """
+    padded = ' {} '.format(name)
+    return set(padded[i:i+n] for i in range(max(1, len(padded) - n + 1)))
+
+
+def build_gram_index(store):
+    """Builds an inverted index from n-grams of every normalized district
+    name to the names containing them, partitioned by district type. Names
+    are numbered 'entries', and each entry points back to its store bucket
+    and its position in the bucket
 
     Keyword arguments:
-    type_val -- district type to search for, valid types: anc, cd, county,
-                    council, village, borough, ward, township, city, court,
-                    parish, state, territory, sldu, commissioner, sldl,
-                    precinct, town, school, country, region, census_area
-    name -- district name to search for
+    store -- OcdidStore of the current ocdids
 
     Returns:
-    match_list[:MATCH_LIMIT] -- a list of the top 'MATCH_LIMIT' matches that
-                                    that at least meet 'MATCH_RATIO'
+    grams -- dict of
+                 entry_bucket -- array of bucket number for each entry
+                 entry_position -- array of name position for each entry
+                 entry_length -- array of normalized name length for each
+                                     entry
+                 postings -- dict of district_type -> n-gram -> array of
+                                 entries
 
     """
-    match_list = []
-
-    # if type_val is standard, use the set of valid district type matches
-    # otherwise accept 'all' matches
-    if type_val in Match.CONVERSIONS:
-        valid_dists = Match.CONVERSIONS[type_val]
-    else:
-        valid_dists == 'all'
-
-    for prefix, district in ocdids.items():
-        for dist_type, dist_names in district.items():
-            # pull the closest match from matching sets of districts, adds to
-            # match_list if > MATCH_RATIO
-            if valid_dists == 'all' or dist_type in valid_dists:
-                match_vals = process.extractOne(name, dist_names)
-                if match_vals and match_vals[1] > Match.RATIO:
-                    match_list.append((match_vals[1], '{}/{}:{}'.format(prefix, dist_type, match_vals[0])))
-
-    # sorts and returns top MATCH_LIMIT matches
-    match_list = sorted(match_list, key=itemgetter(0))
-    match_list.reverse()
-    return match_list[:Match.LIMIT]
+    entry_bucket = array('i')
+    entry_position = array('i')
+    entry_length = array('i')
+    postings = {}
+    for bucket, normalized in enumerate(store.bucket_normalized):
+        if not normalized:
+            continue
+        type_postings = postings.setdefault(store.dist_type(bucket), {})
+        for position, name_id in enumerate(normalized):
+            entry = len(entry_bucket)
+            entry_bucket.append(bucket)
+            entry_position.append(position)
+            entry_length.append(len(store.strings[name_id]))
+            for gram in ngrams(store.strings[name_id]):
+                if gram not in type_postings:
+                    type_postings[gram] = array('i')
+                type_postings[gram].append(entry)
+    return {'entry_bucket': entry_bucket,
+            'entry_position': entry_position,
+            'entry_length': entry_length,
+            'postings': postings}
 
 
-def print_subdistrict_data(ocdid_prefix):
-    """Given a district name, returns closest ocdid match in given district
+def build_length_index(store):
+    """Groups each bucket's normalized names by length, for best_choices
 
     Keyword arguments:
-    ocdid_prefix -- district name to attempt match
+    store -- OcdidStore of the current ocdids
+
+    Returns:
+    lengths -- list per bucket of sorted (length, array of name positions)
 
     """
-    for k, v in ocdids[ocdid_prefix].items():
-        print('  - {}:{}'.format(k, v))
-
-""" If a url is provided, use 'requests' to obtain ocdid data
-        otherwise, read from file system """
-if 'http' in Ocdid.URL:
-    print(Ocdid.URL)
-    r = requests.get(Ocdid.URL)
-    data = io.StringIO(r.text)
-else:
-    data = open(Ocdid.URL, 'r')
-reader = DictReader(data)
-
-""" Generate a set of only ocdid data with empty values removed """
-ocdid_set = set()
-ocdids = {}
-exceptions = {}
-for row in reader:
-    if row['id'] not in Ocdid.NONCURRENT_DIST:
-        # translate utf8 encodings to their closest ascii equivalent
-        ocdid_set.add(row['id'])
-        if row['sameAs']:
-            exceptions[row['id']] = row['sameAs']
-
-""" Create a dictionary of ocdid data in the format:
-        {
-            ocdid_prefix:
-            {
-                district_type:
-                    [name_1,name_2,etc.]
-            }
-        }
-"""
-for ocdid in ocdid_set:
-    prefix_div = ocdid.rfind('/')
-    ocdid_prefix = ocdid[:prefix_div]
-    type_val, name = ocdid[prefix_div+1:].split(':')
-    if ocdid_prefix not in ocdids:
-        ocdids[ocdid_prefix] = {}
-    if type_val not in ocdids[ocdid_prefix]:
-        ocdids[ocdid_prefix][type_val] = []
-    ocdids[ocdid_prefix][type_val].append(name)
+    lengths = []
+    for normalized in store.bucket_normalized:
+        groups = {}
+        for position, name_id in enumerate(normalized):
+            length = len(store.strings[name_id])
+            groups.setdefault(length, array('i')).append(position)
+        lengths.append(sorted(groups.items()))
+    return lengths
+
+
+def district_number(name):
+    """Reads the number of a numbered district from its normalized name,
+    ignoring zero padding and ordinal endings, and reading roman numerals
+    up to 39 ('03', '3rd' and 'iii' are all '3'). A single letter suffix
+    is kept ('3a', '3 a' and '03a' are '3a')
+
+    Keyword arguments:
+    name -- name run through normalize_name
+
+    Returns:
+    number -- the district number as a string, None if the name isn't one
+
+    """
+    match = NUMBER.match(name)
+    if match:
+        return match.group(1) + (match.group(2) or '')
+    if name and ROMAN.match(name):
+        values = [ROMAN_VALUES[c] for c in name]
+        return str(sum(-value if value < values[i+1] else value
+                       for i, value in enumerate(values[:-1])) + values[-1])
+    return None
+
+
+def build_number_index(store):
+    """Indexes the names of numbered districts (Match.NUMBERED_TYPES) by
+    district_number, for best_choices. A bucket is only indexed when all of
+    its names are numbers, so mixed buckets keep name matching
+
+    Keyword arguments:
+    store -- OcdidStore of the current ocdids
+
+    Returns:
+    numbers -- dict of bucket -> dict of district number -> position of
+                   its first name in the bucket
+
+    """
+    numbers = {}
+    for bucket, normalized in enumerate(store.bucket_normalized):
+        if not normalized or \
+                store.dist_type(bucket) not in Match.NUMBERED_TYPES:
+            continue
+        positions = {}
+        for position, name_id in enumerate(normalized):
+            number = district_number(store.strings[name_id])
+            if number is None:
+                break
+            positions.setdefault(number, position)
+        else:
+            numbers[bucket] = positions
+    return numbers
+
+
+def load_snapshot(path, checksum=None):
+    """Loads prebuilt ocdid structures from a snapshot file. The snapshot
+    is two pickles, a small header holding the dataset checksum followed by
+    the data, so a stale snapshot is rejected without unpickling the data
+
+    Keyword arguments:
+    path -- snapshot file location
+    checksum -- checksum of the current ocdid dataset, None to accept any
+
+    Returns:
+    checksum, data -- if the snapshot is current, see build_ocdid_data
+    None -- snapshot missing, unreadable, of another layout version or
+                built from another dataset
+
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+            if header.get('version') != Ocdid.SNAPSHOT_VERSION:
+                return None
+            if checksum is not None and header.get('checksum') != checksum:
+                return None
+            return header.get('checksum'), pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError, AttributeError):
+        return None
+
+
+def write_snapshot(path, checksum, ocdid_data):
+    """Writes ocdid structures to a snapshot file, replacing it atomically so
+    concurrent readers never see a partially written snapshot
+
+    Keyword arguments:
+    path -- snapshot file location
+    checksum -- checksum of the ocdid dataset the data was built from
+    ocdid_data -- build_ocdid_data dict to store
+
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as w:
+            pickle.dump({'checksum': checksum,
+                         'version': Ocdid.SNAPSHOT_VERSION},
+                        w, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(ocdid_data, w, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except IOError:
+        # a read-only location just means the next run rebuilds
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_ocdid_data(data, snapshot=None):
+    """Loads ocdid structures, using the snapshot when it matches the given
+    dataset and rebuilding (and rewriting) it otherwise. A rebuild records
+    the changes from the dataset of the snapshot it replaces, when that was
+    built with the same match config, so cached matches unaffected by them
+    can be kept (see diff_ocdid_data)
+
+    Keyword arguments:
+    data -- raw bytes of the ocdid csv file
+    snapshot -- snapshot file location, None to always parse the csv
+
+    Returns:
+    checksum, data -- see build_ocdid_data
+
+    """
+    checksum = dataset_checksum(data)
+    previous = None
+    if snapshot:
+        cached = load_snapshot(snapshot, checksum)
+        if cached:
+            return cached
+        previous = load_snapshot(snapshot)
+    ocdid_data = parse_ocdid_data(data)
+    # matches made under other config may differ anywhere, the diff of the
+    # datasets doesn't cover them
+    if previous and previous[1].get('config') == ocdid_data['config']:
+        ocdid_data['changes'] = diff_ocdid_data(previous[1], ocdid_data)
+        ocdid_data['changes']['previous'] = previous[0]
+    if snapshot:
+        write_snapshot(snapshot, checksum, ocdid_data)
+    return checksum, ocdid_data
+
+
+def diff_ocdid_data(old_data, new_data):
+    """Compares two versions of the ocdid structures
+
+    Keyword arguments:
+    old_data -- build_ocdid_data dict of the earlier dataset
+    new_data -- build_ocdid_data dict of the later dataset
+
+    Returns:
+    changes -- dict of
+                   added -- set of current ocdids only in new_data
+                   removed -- set of current ocdids only in old_data
+                   same_as -- set of ocdids in both whose 'sameAs' ocdid
+                                  changed
+               load_ocdid_data adds 'previous', the old dataset checksum
+
+    """
+    old_set = old_data['store'].ocdid_set()
+    new_set = new_data['store'].ocdid_set()
+    old_exceptions = old_data['store'].exception_dict()
+    new_exceptions = new_data['store'].exception_dict()
+    same_as = set(ocdid for ocdid in old_set & new_set
+                  if old_exceptions.get(ocdid) != new_exceptions.get(ocdid))
+    return {'added': new_set - old_set,
+            'removed': old_set - new_set,
+            'same_as': same_as}
+
+
+def changed_ocdids(changes):
+    """Every ocdid added, removed or given a new 'sameAs' in changes"""
+    return changes['added'] | changes['removed'] | changes['same_as']
+
+
+def changed_buckets(changes):
+    """Returns the set of (ocdid_prefix, district_type) whose district names
+    or their matches differ between the two datasets of changes
+    """
+    buckets = set()
+    for ocdid in changed_ocdids(changes):
+        prefix_div = ocdid.rfind('/')
+        buckets.add((ocdid[:prefix_div],
+                     ocdid[prefix_div+1:].split(':')[0]))
+    return buckets
+
+
+def changed_regions(changes):
+    """Returns the set of district values directly below the country ocdid
+    ('state:ca') with changes in or under them, including None when the
+    country ocdid itself or an ocdid outside it changed
+    """
+    base = Ocdid.COUNTRY + '/'
+    regions = set()
+    for ocdid in changed_ocdids(changes):
+        if ocdid.startswith(base):
+            regions.add(ocdid[len(base):].split('/')[0])
+        else:
+            regions.add(None)
+    return regions
+
+
+index = OcdidIndex.from_source()
+service = None
+if Ocdid.SERVICE and os.path.exists(Ocdid.SERVICE):
+    use_service()
+
+
+def main():
+    """Build step that (re)writes the ocdid snapshot, run ahead of the
+    processing stages so none of them pay for parsing the csv
+    """
+    usage = 'Build the ocdid snapshot used by the processing scripts'
+    parser = ArgumentParser(usage=usage)
+    parser.add_argument('-u', '--url', action='store', dest='url',
+                        default=Ocdid.URL, help='ocdid csv file or url')
+    parser.add_argument('-o', '--output', action='store', dest='snapshot',
+                        default=Ocdid.SNAPSHOT, help='snapshot file to write')
+    args = parser.parse_args()
+
+    build_index = OcdidIndex.from_source(args.url, args.snapshot)
+    print('Snapshot {} is current ({} ocdids)'.format(
+        args.snapshot, len(build_index.store)))
+    changes = build_index.changes
+    if changes:
+        print('Since the previous dataset: {} added, {} removed, {} sameAs '
+              'changed'.format(len(changes['added']), len(changes['removed']),
+                               len(changes['same_as'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,16 @@
 class Match(object):
     RATIO = 90
     LIMIT = 10
+    NGRAM = 3
+    # names sharing less of a search name's n-grams aren't scored, which
+    # makes name searches approximate
+    NGRAM_OVERLAP = .5
+    PRUNE = True
+    SUGGEST_LIMIT = 3
+    SUGGEST_DISTANCE = 2
+    NAME_PREFIXES = {'place': ('city of', 'village of')}
+    NUMBERED_TYPES = set(['ward', 'precinct', 'council_district', 'sldl',
+                          'sldu', 'cd'])
     CITY_EQUIVALENT = set(['place', 'district'])
     TOWN_EQUIVALENT = set(['place'])
     COUNTY_EQUIVALENT = set(['county', 'parish', 'census_area',
@@ -155,4 +165,11 @@ class Ocdid(object):
         'ocd-division/country:us/state:nv/sldu:washoe_county_2',
         'ocd-division/country:us/state:nv/sldu:washoe_county_3',
         'ocd-division/country:us/state:nv/sldu:washoe_county_3'])
+    COUNTRY = 'ocd-division/country:us'
     URL = './country-us.csv'
+    SNAPSHOT = './country-us.snapshot'
+    DOWNLOAD = './country-us.download.csv'
+    DOWNLOAD_MAX_AGE = 600
+    SNAPSHOT_VERSION = 11
+    ALIASES = './ocdid_aliases.csv'
+    SERVICE = './ocdid.sock'
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from argparse import ArgumentParser
+from functools import partial
+from ocdid_config import Ocdid
+
+"""
+Long running ocdid match service. The daemon loads an ocdid index once and
+  answers match requests over a Unix socket, so scripts and notebooks skip
+  loading the ocdid data. The ocdid module sends its module level matching
+  functions to a running service on its own (see ocdid.use_service).
+
+The protocol is one JSON request per line, answered by one JSON line:
+  {"method": "match_name", "args": [...], "kwargs": {...}} gets
+  {"result": ...} or {"error": "..."}. A JSON list of requests is a batch,
+  answered by the list of their responses
+
+Requirements:
+Python3
+ocdid module (+ module requirements)
+
+Constants from config:
+Ocdid.SERVICE -- socket the service listens on
+Ocdid.URL -- default ocdid csv file or url
+Ocdid.SNAPSHOT -- default ocdid snapshot
+"""
+
+# OcdidIndex methods and properties the service answers, with the conversion
+# restoring the tuples JSON turns into lists
+METHODS = {'match_checksum': None,
+           'is_ocdid': None,
+           'is_exception': None,
+           'get_exception': None,
+           'match_child': tuple,
+           'match_name': tuple,
+           'match_names': lambda result: [tuple(r) for r in result],
+           'match_candidates': lambda result: [[tuple(c) for c in r]
+                                               for r in result],
+           'match_type': None,
+           'ancestors': None,
+           'suggest': lambda result: [tuple(r) for r in result],
+           'get_full_prefix': tuple,
+           'name_search': lambda result: [tuple(r) for r in result],
+           'type_name_search': lambda result: [tuple(r) for r in result]}
+
+
+class ServiceError(Exception):
+    """A request the service could not answer"""
+
+
+class OcdidService(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves an OcdidIndex, one thread per connection. Calls into the
+    index are serialized, it builds some lookups on first use
+    """
+    daemon_threads = True
+
+    def __init__(self, address, index):
+        """Keyword arguments:
+        address -- Unix socket path to listen on
+        index -- OcdidIndex to serve, loaded before listening
+        """
+        index.load()
+        self.index = index
+        self.lock = threading.Lock()
+        socketserver.UnixStreamServer.__init__(self, address, ServiceHandler)
+
+    def answer(self, request):
+        """Runs one request against the index
+
+        Returns:
+        response -- dict of 'result' or 'error'
+
+        """
+        try:
+            method = request['method']
+            if method not in METHODS:
+                raise ValueError('unknown method {}'.format(method))
+            with self.lock:
+                result = getattr(self.index, method)
+                if callable(result):
+                    result = result(*request.get('args', ()),
+                                    **request.get('kwargs', {}))
+            return {'result': result}
+        except Exception as e:
+            return {'error': '{}: {}'.format(type(e).__name__, e)}
+
+
+class ServiceHandler(socketserver.StreamRequestHandler):
+    """Answers the requests of one connection until it closes"""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                response = {'error': 'ValueError: {}'.format(e)}
+            else:
+                if isinstance(request, list):
+                    response = [self.server.answer(r) for r in request]
+                else:
+                    response = self.server.answer(request)
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class OcdidClient(object):
+    """Connection to a running OcdidService, with the served OcdidIndex
+    methods (METHODS) as its own
+    """
+
+    def __init__(self, address=Ocdid.SERVICE, fallback=None):
+        """Keyword arguments:
+        address -- Unix socket path of the service
+        fallback -- OcdidIndex single calls go to once the service can't be
+                        reached, None to raise the connection error. The
+                        service has to match against the same data as the
+                        fallback, otherwise ServiceError is raised
+        """
+        self.fallback = fallback
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.file = self.sock.makefile('rwb')
+        if fallback is not None:
+            try:
+                current = self.match_checksum == fallback.match_checksum
+            except ServiceError:
+                # a service too old to answer match_checksum
+                current = False
+            if not current:
+                self.close()
+                raise ServiceError('the service at {} matches against other '
+                                   'ocdid data'.format(address))
+
+    @property
+    def match_checksum(self):
+        """See OcdidIndex.match_checksum, of the service's index"""
+        return self.call('match_checksum')
+
+    def __getattr__(self, name):
+        if name in METHODS:
+            return partial(self.call, name)
+        raise AttributeError(name)
+
+    def call(self, method, *args, **kwargs):
+        """Runs one OcdidIndex method on the service"""
+        if self.file is not None:
+            try:
+                return self.batch([(method, args, kwargs)])[0]
+            except OSError:
+                if self.fallback is None:
+                    raise
+                self.close()
+        return getattr(self.fallback, method)(*args, **kwargs)
+
+    def batch(self, calls):
+        """Runs several OcdidIndex methods on the service in one round trip
+
+        Keyword arguments:
+        calls -- list of (method, args) or (method, args, kwargs)
+
+        Returns:
+        results -- the result of each call, in the same order
+
+        """
+        requests = [{'method': call[0], 'args': list(call[1]),
+                     'kwargs': call[2] if len(call) > 2 else {}}
+                    for call in calls]
+        self.file.write(json.dumps(requests).encode('utf-8') + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('ocdid service closed the connection')
+        results = []
+        for request, response in zip(requests, json.loads(line.decode('utf-8'))):
+            if 'error' in response:
+                raise ServiceError(response['error'])
+            convert = METHODS.get(request['method'])
+            result = response['result']
+            results.append(convert(result) if convert and result is not None
+                           else result)
+        return results
+
+    def close(self):
+        """Closes the connection"""
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.sock.close()
+            self.file = None
+
+
+def main():
+    # ocdid connects to a running service when it is imported, importing it
+    # here rather than with the module keeps that from importing this module
+    # while it is half loaded
+    import ocdid as ocdidlib
+
+    usage = 'Serve ocdid matching over a Unix socket'
+    parser = ArgumentParser(usage=usage)
+    parser.add_argument('-s', '--socket', action='store', dest='address',
+                        default=Ocdid.SERVICE, help='socket to listen on')
+    parser.add_argument('-u', '--url', action='store', dest='url',
+                        default=Ocdid.URL, help='ocdid csv file or url')
+    parser.add_argument('-o', '--snapshot', action='store', dest='snapshot',
+                        default=Ocdid.SNAPSHOT, help='ocdid snapshot file')
+    args = parser.parse_args()
+
+    index = ocdidlib.OcdidIndex.from_source(args.url, args.snapshot)
+    if os.path.exists(args.address):
+        try:
+            OcdidClient(args.address).close()
+        except OSError:
+            # left behind by a service that didn't shut down cleanly
+            os.remove(args.address)
+        else:
+            raise Exception('Error: a service is already listening on '
+                            '{}'.format(args.address))
+    server = OcdidService(args.address, index)
+    print('Serving {} ocdids on {}'.format(len(index.store), args.address))
+    # stopping the service with a kill also removes the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.address)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+from array import array
+
+"""
+Compact storage of the ocdid dataset. Every ocdid, and every prefix of one,
+  is a numbered node in parent pointer arrays, with district types and names
+  interned in a single string table, so the long prefixes most ocdids share
+  ('ocd-division/country:us/state:xx/county:...') are stored once. Nodes with
+  the same parent and district type form a bucket, the group names are
+  matched within, and each bucket's names are held in arrays. Ocdid strings
+  are only built at the boundary, when an ocdid is looked up or returned
+
+Requirements:
+Python3
+"""
+
+
+class OcdidStore(object):
+    """Compact ocdid dataset, see OcdidStore.build
+
+    Attributes:
+    strings -- list of interned strings: district types, names and
+                   normalized names
+    string_ids -- dict of string -> position in strings
+    roots -- dict of top level ocdid segment ('ocd-division') -> node
+    node_parent -- array of each node's parent node, -1 for roots
+    node_bucket -- array of the bucket each node is in, -1 for roots
+    node_name -- array of the string id of each node's district name
+    node_valid -- bytearray, 1 where the node is a current ocdid rather than
+                      only the prefix of one
+    bucket_parent -- array of each bucket's parent node
+    bucket_type -- array of the string id of each bucket's district type
+    bucket_nodes -- list of arrays of the current ocdid nodes in each bucket
+    bucket_normalized -- list of arrays of the string ids of each bucket's
+                             normalized names, in bucket_nodes order
+    parent_buckets -- dict of node -> array of its buckets that hold
+                          current ocdids, in dataset order
+    exceptions -- dict of node -> official 'sameAs' ocdid
+    """
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.roots = {}
+        self.node_parent = array('i')
+        self.node_bucket = array('i')
+        self.node_name = array('i')
+        self.node_valid = bytearray()
+        self.bucket_parent = array('i')
+        self.bucket_type = array('i')
+        self.bucket_nodes = []
+        self.bucket_normalized = []
+        self.parent_buckets = {}
+        self.exceptions = {}
+        self._width = 0
+        self._buckets = {}
+        self._children = {}
+        self._exact = {}
+
+    @classmethod
+    def build(cls, ocdid_set, exceptions, normalize):
+        """Builds the store from the current ocdids
+
+        Keyword arguments:
+        ocdid_set -- set of all current ocdids
+        exceptions -- dict of ocdids to their official 'sameAs' ocdid
+        normalize -- function normalizing a district name for scoring
+
+        Returns:
+        store -- OcdidStore. Buckets holding current ocdids are numbered
+                     first, grouped by prefix in the order each prefix, then
+                     each of its types, first appears in ocdid_set. Names
+                     keep that order too
+
+        """
+        store = cls()
+
+        # group the names by prefix and type, numbering the groups in the
+        # order they appear
+        groups = {}
+        for ocdid in ocdid_set:
+            prefix_div = ocdid.rfind('/')
+            type_val, name = ocdid[prefix_div+1:].split(':')
+            district = groups.setdefault(ocdid[:prefix_div], {})
+            district.setdefault(type_val, []).append(name)
+        buckets = {}
+        for prefix, district in groups.items():
+            for type_val in district:
+                buckets[(prefix, type_val)] = len(buckets)
+        group_count = len(buckets)
+        bucket_parent = [-1] * group_count
+        bucket_type = [-1] * group_count
+        node_ids = {}
+
+        def add_path(path):
+            """Returns the node of an ocdid or prefix, adding it and any
+            missing ancestors
+            """
+            node = node_ids.get(path)
+            if node is not None:
+                return node
+            prefix_div = path.rfind('/')
+            if prefix_div == -1:
+                node = store._add_node(-1, -1, path)
+                store.roots[path] = node
+            else:
+                prefix = path[:prefix_div]
+                parent = add_path(prefix)
+                type_val, name = path[prefix_div+1:].split(':')
+                bucket = buckets.setdefault((prefix, type_val), len(buckets))
+                if bucket == len(bucket_parent):
+                    bucket_parent.append(-1)
+                    bucket_type.append(-1)
+                bucket_parent[bucket] = parent
+                bucket_type[bucket] = store.intern(type_val)
+                node = store._add_node(parent, bucket, name)
+            node_ids[path] = node
+            return node
+
+        for prefix, type_val in list(buckets):
+            nodes = array('i')
+            normalized = array('i')
+            for name in groups[prefix][type_val]:
+                node = add_path('{}/{}:{}'.format(prefix, type_val, name))
+                store.node_valid[node] = 1
+                nodes.append(node)
+                normalized.append(store.intern(normalize(name)))
+            store.bucket_nodes.append(nodes)
+            store.bucket_normalized.append(normalized)
+
+        # buckets only holding prefixes of current ocdids have no names
+        for bucket in range(group_count, len(bucket_parent)):
+            store.bucket_nodes.append(array('i'))
+            store.bucket_normalized.append(array('i'))
+        store.bucket_parent = array('i', bucket_parent)
+        store.bucket_type = array('i', bucket_type)
+        for bucket in range(group_count):
+            store.parent_buckets.setdefault(bucket_parent[bucket],
+                                            array('i')).append(bucket)
+        for ocdid, same_as in exceptions.items():
+            store.exceptions[node_ids[ocdid]] = same_as
+
+        # lookups are keyed by a single int, the width of the string table
+        # keeps (number, string id) pairs from colliding
+        store._width = len(store.strings)
+        for bucket, parent in enumerate(store.bucket_parent):
+            key = parent * store._width + store.bucket_type[bucket]
+            store._buckets[key] = bucket
+        for node, bucket in enumerate(store.node_bucket):
+            if bucket != -1:
+                key = bucket * store._width + store.node_name[node]
+                store._children[key] = node
+        for bucket, normalized in enumerate(store.bucket_normalized):
+            for position, string_id in enumerate(normalized):
+                key = bucket * store._width + string_id
+                store._exact.setdefault(key, position)
+        return store
+
+    def intern(self, value):
+        """Returns the string id of a value, adding it to the table"""
+        string_id = self.string_ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(value)
+            self.string_ids[value] = string_id
+        return string_id
+
+    def _add_node(self, parent, bucket, name):
+        """Appends a node, returning its number"""
+        self.node_parent.append(parent)
+        self.node_bucket.append(bucket)
+        self.node_name.append(self.intern(name))
+        self.node_valid.append(0)
+        return len(self.node_parent) - 1
+
+    def __len__(self):
+        """Number of current ocdids"""
+        return self.node_valid.count(1)
+
+    def node(self, ocdid):
+        """Returns the node of an ocdid or ocdid prefix, None if not stored"""
+        segments = ocdid.split('/')
+        node = self.roots.get(segments[0])
+        for segment in segments[1:]:
+            if node is None:
+                return None
+            node = self.child(node, segment)
+        return node
+
+    def child(self, node, segment):
+        """Returns the child node of a node for one district value
+        ('county:marin'), None if not stored
+        """
+        dist_type, sep, name = segment.partition(':')
+        bucket = self.bucket(node, dist_type)
+        name_id = self.string_ids.get(name)
+        if bucket is None or name_id is None:
+            return None
+        return self._children.get(bucket * self._width + name_id)
+
+    def bucket(self, node, dist_type):
+        """Returns the bucket of a node's children of a district type, None
+        if it has none
+        """
+        type_id = self.string_ids.get(dist_type)
+        if type_id is None:
+            return None
+        return self._buckets.get(node * self._width + type_id)
+
+    def exact_position(self, bucket, normalized):
+        """Returns the position of the first name of a bucket whose
+        normalized form is the given one, None if no name's is
+        """
+        string_id = self.string_ids.get(normalized)
+        if string_id is None:
+            return None
+        return self._exact.get(bucket * self._width + string_id)
+
+    def find_bucket(self, ocdid_prefix, dist_type):
+        """Returns the bucket of an ocdid prefix and district type, None if
+        there is no such prefix or type
+        """
+        node = self.node(ocdid_prefix)
+        if node is None:
+            return None
+        return self.bucket(node, dist_type)
+
+    def is_valid(self, node):
+        """Whether a node is a current ocdid"""
+        return self.node_valid[node] == 1
+
+    def ocdid(self, node):
+        """Builds the ocdid string of a node"""
+        segments = []
+        while node != -1:
+            segments.append(self.segment(node))
+            node = self.node_parent[node]
+        return '/'.join(reversed(segments))
+
+    def segment(self, node):
+        """District value of a node ('county:marin'), the bare name for roots"""
+        bucket = self.node_bucket[node]
+        if bucket == -1:
+            return self.strings[self.node_name[node]]
+        return '{}:{}'.format(self.dist_type(bucket),
+                              self.strings[self.node_name[node]])
+
+    def children_by_parent(self):
+        """Builds the dict of node -> array of all its child nodes, current
+        ocdids or not, with the roots under -1
+        """
+        children = {}
+        for node, parent in enumerate(self.node_parent):
+            children.setdefault(parent, array('i')).append(node)
+        return children
+
+    def dist_type(self, bucket):
+        """District type of a bucket"""
+        return self.strings[self.bucket_type[bucket]]
+
+    def names(self, bucket):
+        """District names of a bucket, in dataset order"""
+        return [self.strings[self.node_name[node]]
+                for node in self.bucket_nodes[bucket]]
+
+    def ocdid_set(self):
+        """Builds the set of all current ocdids"""
+        return set(self.ocdid(node) for node in range(len(self.node_valid))
+                   if self.node_valid[node])
+
+    def exception_dict(self):
+        """Builds the dict of exception ocdids to their official ocdid"""
+        return dict((self.ocdid(node), same_as)
+                    for node, same_as in self.exceptions.items())
+
+    def ocdid_dict(self):
+        """Builds the dict of ocdid_prefix -> district_type -> [names], in
+        dataset order
+        """
+        ocdids = {}
+        for parent, buckets in self.parent_buckets.items():
+            ocdids[self.ocdid(parent)] = dict(
+                (self.dist_type(bucket), self.names(bucket))
+                for bucket in buckets)
+        return ocdids
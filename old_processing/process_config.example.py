@@ -25,13 +25,16 @@ class Dirs(object):
     QUESTIONS    = '{}/questionable_matches_{}.csv'.format(REPORTS_DIR, DATE_VAL)
     ISSUES       = '{}/non_ocdid_issues_{}.csv'.format(REPORTS_DIR, DATE_VAL)
     URL_FILE = '{}/url_report_{}.csv'.format(REPORTS_DIR, DATE_VAL)
+    MATCH_CACHE  = os.path.join(BASE_DIR, 'match_cache.db')
+    MANIFEST     = os.path.join(BASE_DIR, 'assign_manifest.json')
     SUMMARY_FIELDS = ['state', 'unique_districts', 'non_ocdid_issues',
                       'new_ocdids', 'questionable_ocdid_matches',
                       'unique_urls']
     NEW_DIST_FIELDS = ['state', 'uid', 'county', 'muni', 'office_level',
                        'electoral_district', 'office_name']
     QUESTIONS_FIELDS = ['state', 'uid', 'county', 'muni', 'office_level',
-                        'electoral_district', 'office_name', 'ocdid', 'ratio']
+                        'electoral_district', 'office_name', 'ocdid', 'ratio',
+                        'candidates']
     ISSUES_FIELDS = ['state', 'uid', 'element', 'issue', 'element_data',
                      'electoral_district', 'office_name', 'ocdid']
     URL_FIELDS = ['UID', 'line_number', 'element', 'issue']
@@ -41,6 +44,10 @@ class Assign(object):
     OCD_PREFIX = 'ocd-division/country:us/'
     ALT_COUNTIES = {'la': 'parish', 'ak': 'borough'}
     REPORT_TEMPLATE = u'District: {} OCDID: {} Ratio: {}'
+    CANDIDATES = 3
+    CANDIDATE_TEMPLATE = u'{} ({})'
+    MATCH_CACHE_SIZE = 500000
+    SORT_BUFFER = 200000
     DIST_TYPES = ['ward', 'school', 'precinct', 'council',
                   'park', 'commission', 'house', 'assembly',
                   'senate', 'district']
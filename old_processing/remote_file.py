@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import json
+import os
+import time
+import requests
+
+"""
+Local copy of a remote file, kept up to date with conditional GETs. The
+  response's ETag and Last-Modified headers are saved next to the copy and
+  sent back as If-None-Match and If-Modified-Since, so an unchanged file is
+  answered with a bodyless 304. A changed file is streamed to disk in chunks
+  rather than held in memory, and replaces the copy only once complete. When
+  the server can't be reached the copy is used as is
+
+Requirements:
+Python3
+Requests
+"""
+
+CHUNK_SIZE = 1 << 16
+
+
+def read_headers(path):
+    """Returns the saved validator headers of a local copy, {} if none"""
+    try:
+        with open(path + '.headers', 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_headers(path, headers):
+    """Saves the validator headers of a local copy, with the check time"""
+    saved = {'etag': headers.get('ETag'),
+             'last_modified': headers.get('Last-Modified'),
+             'checked': time.time()}
+    with open(path + '.headers', 'w') as f:
+        json.dump(saved, f)
+
+
+def fetch(url, path, max_age=0, timeout=30):
+    """Brings the local copy of a url up to date
+
+    Keyword arguments:
+    url -- file to download
+    path -- location of the local copy
+    max_age -- seconds after a check during which the copy is used without
+                   asking the server again, so the stages of one run share
+                   a single download
+    timeout -- seconds to wait on the server before using the local copy
+
+    Returns:
+    path -- location of the local copy, now current
+
+    """
+    cached = os.path.exists(path)
+    saved = read_headers(path) if cached else {}
+    if cached and time.time() - saved.get('checked', 0) < max_age:
+        return path
+
+    headers = {}
+    if saved.get('etag'):
+        headers['If-None-Match'] = saved['etag']
+    if saved.get('last_modified'):
+        headers['If-Modified-Since'] = saved['last_modified']
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with requests.get(url, headers=headers, stream=True,
+                          timeout=timeout) as r:
+            if r.status_code == 304 and cached:
+                write_headers(path, saved_response(saved, r.headers))
+                return path
+            r.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+            write_headers(path, r.headers)
+    except requests.RequestException as e:
+        if not cached:
+            raise
+        print('Using cached copy of {}, fetch failed: {}'.format(url, e))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+def saved_response(saved, headers):
+    """Headers to save after a 304, which may update the validators"""
+    return {'ETag': headers.get('ETag') or saved.get('etag'),
+            'Last-Modified': headers.get('Last-Modified') or
+                             saved.get('last_modified')}
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+import multiprocessing
+import sys
+import ocdid as ocdidlib
+from argparse import ArgumentParser
+from ocdid_config import Ocdid
+
+"""
+Name searches (name_search, type_name_search) spread over a pool of worker
+  processes. Every search is split into shards of the ocdid buckets (see
+  OcdidIndex.shard), each shard is searched by a worker and the per-shard
+  top matches are merged, so the results are those of a single process
+  search. A batch of names is sent to the pool at once, keeping every core
+  busy
+
+Workers are forked from the process that creates the pool once its index is
+  loaded, so they share the loaded index rather than each receiving a copy
+  of it with every search
+
+Requirements:
+Python3
+ocdid module (+ module requirements)
+
+Constants from config:
+Ocdid.URL -- default ocdid csv file or url
+Ocdid.SNAPSHOT -- default ocdid snapshot
+"""
+
+_index = None
+_shards = {}
+
+
+def _init_worker(index):
+    """Keeps the pool's index in the worker"""
+    global _index
+    _index = index
+
+
+def _search_shard(task):
+    """Searches one shard of the worker's index
+
+    Keyword arguments:
+    task -- tuple of (name, valid_dists, shard number, shard count)
+
+    Returns:
+    match_heap -- see OcdidIndex.search_heap
+
+    """
+    name, valid_dists, number, count = task
+    shard = _shards.get((number, count))
+    if shard is None:
+        shard = _shards[(number, count)] = _index.shard(number, count)
+    return shard.search_heap(name, valid_dists)
+
+
+class SearchPool(object):
+    """Pool of worker processes for name searches over one OcdidIndex"""
+
+    def __init__(self, index, processes=None, shards=None):
+        """Keyword arguments:
+        index -- OcdidIndex to search, loaded before the workers start
+        processes -- number of worker processes, the number of cores if None
+        shards -- number of shards each search is split into, processes if
+                      None
+        """
+        index.load()
+        self.index = index
+        self.processes = processes or multiprocessing.cpu_count()
+        self.shards = shards or self.processes
+        self.pool = multiprocessing.get_context('fork').Pool(
+            self.processes, _init_worker, (index,))
+
+    def name_searches(self, names):
+        """OcdidIndex.name_search for each of a batch of names
+
+        Returns:
+        [match_list] -- one name_search result per name, in the same order
+
+        """
+        return self._searches(names, None)
+
+    def type_name_searches(self, type_val, names):
+        """OcdidIndex.type_name_search for each of a batch of names
+
+        Returns:
+        [match_list] -- one type_name_search result per name, in the same
+                            order
+
+        """
+        return self._searches(names, self.index.valid_dists(type_val))
+
+    def name_search(self, name):
+        """See OcdidIndex.name_search"""
+        return self.name_searches([name])[0]
+
+    def type_name_search(self, type_val, name):
+        """See OcdidIndex.type_name_search"""
+        return self.type_name_searches(type_val, [name])[0]
+
+    def _searches(self, names, valid_dists):
+        """Searches every shard for every name and merges the shards"""
+        tasks = [(name, valid_dists, number, self.shards)
+                 for name in names for number in range(self.shards)]
+        heaps = self.pool.map(_search_shard, tasks)
+        return [ocdidlib.search_results(ocdidlib.merge_search_heaps(
+                    heaps[i:i + self.shards]))
+                for i in range(0, len(heaps), self.shards)]
+
+    def close(self):
+        """Stops the worker processes"""
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    usage = 'Search ocdids by district name, using every core'
+    parser = ArgumentParser(usage=usage)
+    parser.add_argument('names', nargs='*',
+                        help='district names, read one per line from stdin '
+                             'if none are given')
+    parser.add_argument('-t', '--type', action='store', dest='type_val',
+                        default=None, help='district type to search')
+    parser.add_argument('-j', '--jobs', action='store', dest='jobs',
+                        type=int, default=None,
+                        help='number of worker processes, defaults to the '
+                             'number of cores')
+    parser.add_argument('-u', '--url', action='store', dest='url',
+                        default=Ocdid.URL, help='ocdid csv file or url')
+    parser.add_argument('-o', '--snapshot', action='store', dest='snapshot',
+                        default=Ocdid.SNAPSHOT, help='ocdid snapshot file')
+    args = parser.parse_args()
+
+    names = args.names or [line.strip() for line in sys.stdin if line.strip()]
+    index = ocdidlib.OcdidIndex.from_source(args.url, args.snapshot)
+    with SearchPool(index, args.jobs) as pool:
+        if args.type_val:
+            results = pool.type_name_searches(args.type_val, names)
+        else:
+            results = pool.name_searches(names)
+    for name, match_list in zip(names, results):
+        print(name)
+        for ratio, ocdid in match_list:
+            print('  {} {}'.format(ratio, ocdid))
+
+
+if __name__ == '__main__':
+    main()
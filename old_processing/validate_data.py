@@ -107,7 +107,8 @@ def validate(f, u):
         rows = [row for row in reader]
         w = open(production_file_path, 'w', encoding='utf-16')
 
-    writer = DictWriter(w, fieldnames=reader.fieldnames[:-1],
+    writer = DictWriter(w, fieldnames=[field for field in reader.fieldnames[:-1]
+                                       if field != 'ocdid_candidates'],
                         extrasaction='ignore',
                         dialect='excel-tab')
     writer.writeheader()
@@ -219,7 +220,8 @@ def validate(f, u):
                                   'electoral_district': row['Electoral District'],
                                   'office_name': row['Office Name'],
                                   'ocdid': row['OCDID'],
-                                  'ratio': ratio})
+                                  'ratio': ratio,
+                                  'candidates': row.get('ocdid_candidates', '')})
         else:
             new_dist_hash = hash(row['Body Represents - County']+row['Electoral District'])
             if new_dist_hash not in new_dist:
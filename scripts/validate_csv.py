@@ -11,17 +11,35 @@ import argparse
 import csv
 import itertools
 import nameparser.config
+import os
 import re
 import phonenumbers
+import sys
 
 nameparser.config.CONSTANTS.string_format = '{first} {last}'
 
 arg_parser = ArgumentParser(prog='validate_csv.py',
                             description='Validate a GovProj CSV file.')
 arg_parser.add_argument('state')
+arg_parser.add_argument('--ocdids', metavar='SOURCE',
+                        help='check that OCDIDs exist in this ocdid csv file, '
+                             'url or snapshot, suggesting the closest valid '
+                             'OCDIDs for ones that do not')
 
 args = vars(arg_parser.parse_args())
 
+# the ocdid index loads from its snapshot, and builds the suggestion index
+# only for the parts of the ocdid tree a missing OCDID is looked up in
+ocdid_index = None
+if args['ocdids']:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 os.pardir, 'old_processing'))
+    import ocdid as ocdidlib
+    if args['ocdids'].endswith('.snapshot'):
+        ocdid_index = ocdidlib.OcdidIndex.from_snapshot(args['ocdids'])
+    else:
+        ocdid_index = ocdidlib.OcdidIndex.from_source(args['ocdids'])
+
 csv_path = '{state} Office Holders.csv'.format(state=args['state'])
 csv_file = open(csv_path)
 reader = csv.DictReader(csv_file)
@@ -300,7 +318,7 @@ def has_illegal_chars(string):
     has_bad_ascii_chars = any((lambda bad_char: bad_char in string)(char) for
                               char in bad_ascii_chars)
     try:
-        if not has_bad_ascii_chars and unidecode(unicode(string)):
+        if not has_bad_ascii_chars and unidecode(str(string)):
             return False
         else:
             return True
@@ -354,6 +372,18 @@ ocdid_pattern = re.compile(
     r'ocd-division/country:us(?:/(?:state|district):[a-z]{2}(?:/[-\w:/~]+)?)?'
 )
 
+
+def ocdid_exists(ocdid):
+    return ocdid_index is None or ocdid == '' or ocdid_index.is_ocdid(ocdid)
+
+
+def missing_ocdid_error(ocdid):
+    suggestions = [suggestion for distance, suggestion in
+                   ocdid_index.suggest(ocdid)]
+    if suggestions:
+        return 'OCDID does not exist, closest: ' + ', '.join(suggestions)
+    return 'OCDID does not exist'
+
 validators = {
     'Person UUID': [
         # {'check': lambda val: val == '' or bool(uuid_pattern.match(val)),
@@ -473,9 +503,11 @@ validators = {
         {'check': lambda val: val == '' or uri_is_well_formed(val),
          'error': 'Youtube is malformed'}
     ],
-    'ocdid': [
+    'OCDID': [
         {'check': lambda val: val == '' or ocdid_pattern.match(val),
-         'error': 'OCDID is malformed'}
+         'error': 'OCDID is malformed'},
+        {'check': ocdid_exists,
+         'error': missing_ocdid_error}
     ]
 }
 
@@ -525,26 +557,27 @@ def validate_cell(column, value):
     if column not in validators.keys():
         return []
 
-    errors = filter(None, [None if validator['check'](value) else
-                           validator['error'] for validator in
-                           validators[column]])
+    # an error can be a function of the value, for messages that need it
+    errors = [error(value) if callable(error) else error for error in
+              (validator['error'] for validator in validators[column]
+               if not validator['check'](value))]
 
     return errors
 
 errors = [validate_row(i, row) for i, row in enumerate(csv_rows) if
           row['Official Name'] != '']
 errors = list(k for k, _ in itertools.groupby(
-    error for error in sorted(errors) if error['errors'] != []))
-errors.sort(key=lambda error: error['row'])
+    error for error in sorted(errors, key=lambda error: error['row'])
+    if error['errors'] != []))
 
 
 if len(errors) > 0:
-    print csv_file.name + ' has errors'
+    print(csv_file.name + ' has errors')
 
     for error in errors:
         pprint(error)
-        print
+        print()
 
 
 else:
-    print csv_file.name + ' validates'
+    print(csv_file.name + ' validates')